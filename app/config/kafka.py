@@ -16,12 +16,21 @@ class KafkaConfig:
             kafka_bootstrap_servers = os.getenv(
                 "KAFKA_BOOTSTRAP_SERVERS", "kafka:9092")
 
+            # 批量发送配置：消息在缓冲区中最多等待linger_ms，与同批其他消息一起压缩发送
+            linger_ms = int(os.getenv("KAFKA_LINGER_MS", "5"))
+            max_batch_size = int(os.getenv("KAFKA_MAX_BATCH_SIZE", "65536"))
+            # 压缩算法（gzip/snappy/lz4/zstd），为空表示不压缩
+            compression_type = os.getenv("KAFKA_COMPRESSION_TYPE") or None
+
             # 创建生产者
             cls._producer = AIOKafkaProducer(
                 bootstrap_servers=kafka_bootstrap_servers,
                 retry_backoff_ms=500,  # 重试间隔
                 request_timeout_ms=5000,  # 请求超时时间（毫秒）
-                enable_idempotence=True  # 启用幂等性，确保消息只被发送一次
+                enable_idempotence=True,  # 启用幂等性，确保消息只被发送一次
+                linger_ms=linger_ms,  # 批次最长等待时间（毫秒）
+                max_batch_size=max_batch_size,  # 单个分区批次的最大字节数
+                compression_type=compression_type  # 批次压缩算法
             )
 
             # 启动生产者
@@ -38,3 +47,12 @@ class KafkaConfig:
 
     # 投票事件的topic名称
     VOTES_TOPIC = "votes"
+    # 死信队列topic名称
+    VOTES_DLQ_TOPIC = "votes.dlq"
+
+    @classmethod
+    def get_retry_tiers(cls):
+        """获取重试层级 [(topic, 延迟秒数)]，例如 votes.retry.5s、votes.retry.60s"""
+        delays = os.getenv("VOTE_RETRY_DELAYS", "5,60")
+        return [(f"{cls.VOTES_TOPIC}.retry.{int(delay)}s", int(delay))
+                for delay in delays.split(",") if delay.strip()]
@@ -0,0 +1,41 @@
+import hmac
+import hashlib
+import os
+import time
+from typing import Optional
+
+
+class TicketConfig:
+    """票据配置类，票据ID自带签发时间戳和HMAC签名，可在进程内无状态校验"""
+
+    # 从环境变量获取配置，如果没有则使用默认值
+    SECRET_KEY = os.getenv("TICKET_SECRET_KEY", "cast_secret_key").encode()  # HMAC密钥
+    VALID_DURATION = int(os.getenv("TICKET_VALID_DURATION", "2"))  # 有效期（秒）
+    # 本地过期判断的时钟误差容忍度（毫秒），最终以Redis TIME为准
+    CLOCK_SKEW_MS = int(os.getenv("TICKET_CLOCK_SKEW_MS", "500"))
+    # 下一个票据在当前票据过期前提前发布的时间（毫秒），期间两个票据同时有效
+    OVERLAP_MS = int(os.getenv("TICKET_OVERLAP_MS", "500"))
+
+    @classmethod
+    def sign(cls, timestamp: int) -> str:
+        """生成票据ID，格式为 <签发时间戳>.<HMAC(密钥, 时间戳)>"""
+        h = hmac.new(cls.SECRET_KEY, str(timestamp).encode(), hashlib.sha256)
+        return f"{timestamp}.{h.hexdigest()}"
+
+    @classmethod
+    def verify(cls, ticket: str) -> Optional[str]:
+        """在本地校验票据签名和有效期，校验失败时返回错误信息，成功时返回None"""
+        timestamp, _, signature = ticket.partition(".")
+        if not (timestamp.isascii() and timestamp.isdigit() and len(timestamp) <= 12) \
+                or len(signature) != hashlib.sha256().digest_size * 2:
+            return "Invalid ticket"
+
+        # 常量时间比较，避免通过响应时间推测签名
+        expected = cls.sign(int(timestamp))
+        if not hmac.compare_digest(expected.encode(), ticket.encode()):
+            return "Invalid ticket"
+
+        expires_at_ms = (int(timestamp) + cls.VALID_DURATION) * 1000
+        if time.time() * 1000 > expires_at_ms + cls.CLOCK_SKEW_MS:
+            return "Ticket expired"
+        return None
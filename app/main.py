@@ -1,27 +1,52 @@
 import asyncio
+import json
+import time
 import strawberry
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from strawberry.fastapi import GraphQLRouter
 from contextlib import asynccontextmanager
 from fastapi.responses import JSONResponse
 
 from .schema.queries import Query
 from .schema.mutations import Mutation
+from .schema.context import get_context
 from .database.db import init_db
+from .config.redis import RedisConfig
+from .config.ticket import TicketConfig
+from .services.script_registry import script_registry
+from .services.vote_service import vote_service
+from .services.ticket_service import ticket_service
+from .services.rehydration_service import rehydration_service
 
 # 创建GraphQL schema
 schema = strawberry.Schema(query=Query, mutation=Mutation)
 
 # 创建GraphQL路由
-graphql_app = GraphQLRouter(schema)
+graphql_app = GraphQLRouter(schema, context_getter=get_context)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 初始化数据库
     await init_db()
+    # 预加载所有Lua脚本，之后通过EVALSHA调用
+    await script_registry.load_all()
+    # 需要时从PostgreSQL恢复Redis中的票数，最多等待有限时间，之后在后台继续
+    await rehydration_service.start()
+    # 补发上次运行遗留在磁盘中的投票事件
+    if vote_service.event_queue is not None:
+        vote_service.event_queue.start()
     # 票据生成服务已经移动到独立的服务中
     yield
+    await rehydration_service.stop()
+    # 发送事件队列中剩余的投票事件
+    if vote_service.event_queue is not None:
+        await vote_service.event_queue.close()
+    await vote_service.cache.close()
+    await vote_service.stripes.close()
+    await ticket_service.close()
+    # 释放Redis连接池
+    await RedisConfig.close_redis()
 
 # 创建FastAPI应用
 app = FastAPI(title="Little Vote", lifespan=lifespan)
@@ -33,5 +58,81 @@ app = FastAPI(title="Little Vote", lifespan=lifespan)
 async def health_check():
     return JSONResponse(status_code=200, content={"status": "healthy"})
 
+
+@app.get("/cas")
+async def cas(request: Request):
+    """以HTTP GET获取当前票据，可被入口和客户端缓存
+
+    ETag由当前票据和下一个票据确定，max-age为距离响应内容变化（下一个票据发布或当前票据过期）的秒数，
+    If-None-Match匹配时返回304。响应只包含在缓存期间不变的字段，剩余使用次数随每次投票变化，
+    不在此返回，需要时通过GraphQL的cas查询获取。
+    """
+    ticket = await ticket_service.get_current_ticket()
+    if not ticket["id"]:
+        return JSONResponse(status_code=503, content={"error": ticket.get("error")},
+                            headers={"Cache-Control": "no-store"})
+
+    next_ticket = ticket["next"]
+    # 票据ID以签发时间戳开头，时间戳即可唯一确定票据
+    etag = f'"{ticket["id"].partition(".")[0]}-{next_ticket["id"].partition(".")[0] if next_ticket else 0}"'
+    changes_at_ms = ticket["expiresAtMs"] if next_ticket else ticket["expiresAtMs"] - TicketConfig.OVERLAP_MS
+    max_age = max(int((changes_at_ms - time.time() * 1000) // 1000), 0)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    def to_json(info):
+        return {"ticket": info["id"], "validUntil": info["expiresAt"]}
+
+    content = to_json(ticket)
+    content["next"] = to_json(next_ticket) if next_ticket else None
+    return JSONResponse(status_code=200, content=content, headers=headers)
+
+
+@app.get("/metrics/scripts")
+async def script_metrics():
+    """Lua脚本调用次数与延迟统计"""
+    return JSONResponse(status_code=200, content=script_registry.get_stats())
+
+
+@app.get("/metrics/vote-events")
+async def vote_event_metrics():
+    """投票事件队列深度与丢弃计数"""
+    stats = vote_service.event_queue.get_stats() if vote_service.event_queue is not None else {}
+    return JSONResponse(status_code=200, content=stats)
+
+
+@app.get("/metrics/vote-cache")
+async def vote_cache_metrics():
+    """进程内票数读缓存的命中、未命中和淘汰计数"""
+    return JSONResponse(status_code=200, content=vote_service.cache.get_stats())
+
+
+@app.get("/metrics/vote-stripes")
+async def vote_stripe_metrics():
+    """热点用户与条带合并统计"""
+    return JSONResponse(status_code=200, content=vote_service.stripes.get_stats())
+
+
+@app.get("/metrics/rehydration")
+async def rehydration_metrics():
+    """Redis票数恢复状态"""
+    return JSONResponse(status_code=200, content=rehydration_service.get_stats())
+
+
+@app.get("/metrics/reconcile")
+async def reconcile_metrics():
+    """Redis与PostgreSQL票数对账统计（由vote-reconciler写入）"""
+    stats = await RedisConfig.get_redis().hgetall("vote_reconcile_stats")
+    return JSONResponse(status_code=200, content={key: json.loads(value) for key, value in stats.items()})
+
+
+@app.get("/metrics/outbox")
+async def outbox_metrics():
+    """发件箱转发统计（由outbox-relay写入），trimmed为转发前被外部删除而丢失的消息数"""
+    stats = await RedisConfig.get_redis().hgetall("vote_outbox_stats")
+    return JSONResponse(status_code=200, content={key: int(value) for key, value in stats.items()})
+
 # 添加GraphQL路由
 app.include_router(graphql_app, prefix="/graphql")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime
+from sqlalchemy import Column, String, Integer, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -11,3 +11,7 @@ class Vote(Base):
     username = Column(String, unique=True, index=True)
     count = Column(Integer, default=0)
     version = Column(Integer, default=0)
+
+
+# 排行榜查询（按票数降序、同票数按用户名降序，与Redis有序集合的ZREVRANGE顺序一致）使用的索引
+votes_count_index = Index("ix_votes_count_username", Vote.count.desc(), Vote.username.desc())
@@ -0,0 +1,81 @@
+import json
+from typing import List, Tuple, Union
+
+import msgpack
+
+# 紧凑格式的schema版本号，作为消息的第一个字节
+# JSON格式的消息总是以'{'开头，消费者据此区分两种格式
+COMPACT_SCHEMA_VERSION = 1
+
+
+def encode_vote_events(usernames: List[str], vote_counts: List[int], ticket: str,
+                       voter_username: str, timestamp: str, version: Union[int, List[int]],
+                       compact: bool = False) -> List[Tuple[bytes, bytes]]:
+    """将一次投票编码为Kafka消息，返回 (key, value) 列表
+
+    JSON格式每个目标用户一条消息；紧凑格式整次投票一条msgpack消息，
+    包含 (目标用户, 最新票数) 列表，公共字段只出现一次。
+    version为列表时表示每个目标用户各自的版本号（票数分片时由各分片分别编号），
+    紧凑格式按版本号拆分为多条消息。
+    """
+    voter = voter_username or "anonymous"
+    if isinstance(version, list):
+        if not compact:
+            return [message for i, username in enumerate(usernames)
+                    for message in encode_vote_events([username], [vote_counts[i]], ticket,
+                                                      voter_username, timestamp, version[i])]
+        groups = {}
+        for i, target_version in enumerate(version):
+            groups.setdefault(target_version, []).append(i)
+        return [message for target_version, indices in groups.items()
+                for message in encode_vote_events([usernames[i] for i in indices],
+                                                  [vote_counts[i] for i in indices], ticket,
+                                                  voter_username, timestamp, target_version, compact=True)]
+
+    if compact:
+        record = {
+            "voter": voter,
+            "ticket": ticket,
+            "timestamp": timestamp,
+            "version": version,
+            "targets": [[username, vote_counts[i]] for i, username in enumerate(usernames)]
+        }
+        value = bytes([COMPACT_SCHEMA_VERSION]) + msgpack.packb(record)
+        # 消费者按版本号取最大值，不依赖同一用户的消息进入同一分区，以第一个目标用户作为key
+        return [(usernames[0].encode('utf-8'), value)] if usernames else []
+
+    messages = []
+    for i, username in enumerate(usernames):
+        vote_event = {
+            "voter": voter,
+            "target": username,
+            "count": vote_counts[i],
+            "ticket": ticket,
+            "timestamp": timestamp,
+            "version": version
+        }
+        # 使用目标用户名作为key，确保相同用户的投票进入相同分区
+        messages.append((username.encode('utf-8'), json.dumps(vote_event).encode('utf-8')))
+    return messages
+
+
+def decode_vote_events(value: bytes) -> List[dict]:
+    """解码Kafka消息，兼容JSON和紧凑格式，返回单个目标用户的投票事件列表"""
+    if value[:1] == b'{':
+        return [json.loads(value.decode('utf-8'))]
+
+    if value[0] != COMPACT_SCHEMA_VERSION:
+        raise ValueError(f"Unsupported vote event schema version: {value[0]}")
+
+    record = msgpack.unpackb(value[1:])
+    return [
+        {
+            "voter": record["voter"],
+            "target": target,
+            "count": count,
+            "ticket": record["ticket"],
+            "timestamp": record["timestamp"],
+            "version": record["version"]
+        }
+        for target, count in record["targets"]
+    ]
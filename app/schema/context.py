@@ -0,0 +1,14 @@
+# context.py
+from strawberry.dataloader import DataLoader
+
+from ..services.vote_service import vote_service
+
+
+async def get_context() -> dict:
+    """为每次GraphQL请求创建上下文
+
+    DataLoader按请求创建，同一次执行中的所有票数查询（包括别名字段）合并为一次HMGET。
+    """
+    return {
+        "vote_loader": DataLoader(load_fn=vote_service.get_users_votes)
+    }
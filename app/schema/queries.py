@@ -1,23 +1,69 @@
 # queries.py
 import strawberry
-from .types import TicketInfo
-from ..services.vote_service import vote_service
+from typing import List, Optional
+from .types import TicketInfo, LeaderboardEntry, VoteEvent
 from ..services.ticket_service import ticket_service
+from ..services.leaderboard_service import leaderboard_service
+from ..services.vote_service import vote_service
 
 
 @strawberry.type
 class Query:
     @strawberry.field
-    async def query(self, username: str) -> int:
+    async def query(self, username: str, info: strawberry.Info) -> int:
         """查询指定用户的票数"""
-        return await vote_service.get_user_votes(username)
+        return await info.context["vote_loader"].load(username)
+
+    @strawberry.field
+    async def votes(self, usernames: List[str], info: strawberry.Info) -> List[int]:
+        """批量查询多个用户的票数，结果与usernames顺序一致"""
+        return await info.context["vote_loader"].load_many(usernames)
+
+    @strawberry.field
+    async def top_voted(self, limit: int = 10, offset: int = 0) -> List[LeaderboardEntry]:
+        """按票数降序返回排行榜（limit最大为1000）"""
+        offset = max(offset, 0)
+        entries = await leaderboard_service.top_voted(limit, offset)
+        return [
+            LeaderboardEntry(username=username, votes=count, rank=offset + i + 1)
+            for i, (username, count) in enumerate(entries)
+        ]
+
+    @strawberry.field
+    async def rank(self, username: str) -> Optional[int]:
+        """查询用户在排行榜中的名次（从1开始），未获得过投票时返回null"""
+        return await leaderboard_service.rank(username)
+
+    @strawberry.field
+    async def vote_events(self, voter: Optional[str] = None, target: Optional[str] = None,
+                          since: Optional[str] = None, until: Optional[str] = None,
+                          limit: int = 100) -> List[VoteEvent]:
+        """按投票人或目标用户和时间范围（ISO-8601，默认最近24小时）查询投票审计记录，按时间倒序"""
+        events = await vote_service.get_vote_events(voter, target, since, until, limit)
+        return [
+            VoteEvent(
+                voter=event["voter"],
+                target=event["target"],
+                count=event["count"],
+                ticket=event["ticket"] or "",
+                version=event["version"] or 0,
+                created_at=event["created_at"].isoformat()
+            )
+            for event in events
+        ]
 
     @strawberry.field
     async def cas(self) -> TicketInfo:
-        """获取当前有效的票据"""
+        """获取当前有效的票据，以及已提前发布的下一个票据"""
         ticket = await ticket_service.get_current_ticket()
+        next_ticket = ticket["next"]
         return TicketInfo(
             ticket=ticket["id"],
             valid_until=ticket["expiresAt"],
-            remaining_usage=ticket["usageCount"]
+            remaining_usage=ticket["usageCount"],
+            next=TicketInfo(
+                ticket=next_ticket["id"],
+                valid_until=next_ticket["expiresAt"],
+                remaining_usage=next_ticket["usageCount"]
+            ) if next_ticket else None
         )
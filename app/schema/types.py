@@ -1,5 +1,5 @@
 import strawberry
-from typing import List
+from typing import List, Optional
 
 
 @strawberry.type
@@ -10,8 +10,26 @@ class VoteResult:
     votes: List[int]
 
 
+@strawberry.type
+class LeaderboardEntry:
+    username: str
+    votes: int
+    rank: int
+
+
+@strawberry.type
+class VoteEvent:
+    voter: str
+    target: str
+    count: int
+    ticket: str
+    version: int
+    created_at: str
+
+
 @strawberry.type
 class TicketInfo:
     ticket: str
     valid_until: str
     remaining_usage: int
+    next: Optional["TicketInfo"] = None  # 已提前发布的下一个票据，在当前票据过期前即可使用
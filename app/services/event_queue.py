@@ -0,0 +1,194 @@
+import asyncio
+import json
+import os
+from collections import deque
+from typing import Awaitable, Callable, List
+
+
+class EventQueueFullError(Exception):
+    """事件队列已满且按策略拒绝请求"""
+
+
+class VoteEventQueue:
+    """有界的进程内投票事件队列，由后台任务批量发送到Kafka
+
+    请求在写入Redis之前先预留队列位置，队列已满时按策略处理：
+    - block: 最多等待put_timeout秒，超时后拒绝请求
+    - shed: 立即拒绝请求
+    - spill: 事件写入本地磁盘文件，队列空闲后再补发
+    事件发送成功后才释放位置，Kafka变慢时压力会传导到请求入口，内存占用保持有界。
+    磁盘中有事件时后台任务持续按退避间隔重试补发，不依赖新的请求唤醒；关闭时未发送的内存事件也写入磁盘，
+    由同一个磁盘目录上的下一个进程通过start()补发。磁盘文件只在目录保留期间有效（k8s中为Pod的emptyDir，
+    容器重启后保留，Pod被删除时丢失），需要可靠投递时使用发件箱（VOTE_OUTBOX_ENABLED）。
+    """
+
+    POLICIES = ("block", "shed", "spill")
+
+    def __init__(self, publish: Callable[[List[dict]], Awaitable[None]]):
+        self.publish = publish
+        # 从环境变量获取配置，如果没有则使用默认值
+        self.maxsize = int(os.getenv("VOTE_EVENT_QUEUE_SIZE", "10000"))
+        self.policy = os.getenv("VOTE_EVENT_QUEUE_POLICY", "block")
+        self.put_timeout = float(os.getenv("VOTE_EVENT_QUEUE_PUT_TIMEOUT", "0.5"))
+        self.batch_size = int(os.getenv("VOTE_EVENT_QUEUE_BATCH_SIZE", "500"))
+        self.spill_path = os.getenv("VOTE_EVENT_SPILL_PATH", "/var/lib/cast/vote_events.spill")
+        self.replay_path = f"{self.spill_path}.replay"
+        if self.policy not in self.POLICIES:
+            raise ValueError(f"Unknown vote event queue policy: {self.policy}")
+
+        self._slots = asyncio.Semaphore(self.maxsize)
+        self._events = deque()
+        self._has_events = asyncio.Event()
+        self._spill_lock = asyncio.Lock()  # 串行化磁盘文件的追加与移出，避免追加写入已被读取的文件
+        self._flusher = None
+        self._stats = {
+            "enqueued": 0,
+            "published": 0,
+            "shed": 0,
+            "timed_out": 0,
+            "spilled": 0,
+            "publish_errors": 0
+        }
+
+    def start(self):
+        """补发上次运行遗留在磁盘中的事件"""
+        if self._has_spill():
+            self._has_events.set()
+            self._ensure_flusher()
+
+    async def reserve(self) -> bool:
+        """为一个事件预留队列位置，返回False表示事件应写入磁盘；按策略拒绝时抛出EventQueueFullError"""
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return True
+
+        if self.policy == "spill":
+            return False
+        if self.policy == "shed":
+            self._stats["shed"] += 1
+            raise EventQueueFullError("Vote service is overloaded, please retry later")
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.put_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self._stats["timed_out"] += 1
+            raise EventQueueFullError("Vote service is overloaded, please retry later")
+
+    def release(self, reserved: bool):
+        """释放未使用的预留位置（例如票据校验失败）"""
+        if reserved:
+            self._slots.release()
+
+    async def put(self, event: dict, reserved: bool):
+        """将事件放入队列（已预留位置）或写入磁盘"""
+        if reserved:
+            self._events.append(event)
+            self._stats["enqueued"] += 1
+        else:
+            await self._spill([event])
+            self._stats["spilled"] += 1
+        self._has_events.set()
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        """按需启动后台发送任务"""
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        """后台发送循环：批量取出事件发送，失败时保留事件并退避重试"""
+        while True:
+            await self._has_events.wait()
+            if self._events:
+                batch = [self._events[i] for i in range(min(self.batch_size, len(self._events)))]
+                if await self._publish_batch(batch):
+                    for _ in batch:
+                        self._events.popleft()
+                        self._slots.release()
+                continue
+
+            # 内存队列已清空，补发磁盘中的事件；补发失败时事件写回磁盘，下一轮退避后继续重试
+            if self._has_spill():
+                await self._replay_spill()
+            if not self._events and not self._has_spill():
+                self._has_events.clear()
+
+    def _has_spill(self) -> bool:
+        return os.path.exists(self.spill_path) or os.path.exists(self.replay_path)
+
+    async def _publish_batch(self, batch: List[dict]) -> bool:
+        """发送一批事件，失败时等待一段时间后返回False"""
+        try:
+            await self.publish(batch)
+            self._stats["published"] += len(batch)
+            return True
+        except Exception as e:
+            self._stats["publish_errors"] += 1
+            print(f"Error publishing vote events, will retry: {e}")
+            await asyncio.sleep(1)
+            return False
+
+    async def _replay_spill(self):
+        """将磁盘中的事件移出后分批补发，发送失败的部分重新写回磁盘"""
+        # 上次补发中断时遗留的文件优先处理；移出和读取期间不会有追加写入
+        async with self._spill_lock:
+            if not os.path.exists(self.replay_path):
+                await asyncio.to_thread(os.replace, self.spill_path, self.replay_path)
+            events = await asyncio.to_thread(self._read_events, self.replay_path)
+        for start in range(0, len(events), self.batch_size):
+            if not await self._publish_batch(events[start:start + self.batch_size]):
+                await self._spill(events[start:])
+                break
+        await asyncio.to_thread(os.remove, self.replay_path)
+
+    async def _spill(self, events: List[dict]):
+        """将事件追加到磁盘文件"""
+        async with self._spill_lock:
+            await asyncio.to_thread(self._append_spill, events)
+
+    def _append_spill(self, events: List[dict]):
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+    @staticmethod
+    def _read_events(path: str) -> List[dict]:
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    async def close(self, timeout: float = 5.0):
+        """等待内存和磁盘中的事件发送完成后停止后台任务，超时未发送的内存事件写入磁盘，由下一个进程补发"""
+        if self._flusher is None:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        if self._events:
+            # 正在发送的批次可能已被Kafka接收，补发时可能重复，由消费者按版本号去重
+            print(f"Spilling {len(self._events)} unsent vote events to {self.spill_path} on shutdown")
+            await self._spill(list(self._events))
+            self._events.clear()
+        if self._has_spill():
+            print(f"Unsent vote events remain in {self.spill_path}, they are replayed only if the next process "
+                  f"starts on the same volume (lost if the pod is deleted)")
+
+    async def _drain(self):
+        while self._events or self._has_spill():
+            await asyncio.sleep(0.05)
+
+    def get_stats(self) -> dict:
+        """获取队列深度与丢弃计数"""
+        return {
+            "policy": self.policy,
+            "depth": len(self._events),
+            "capacity": self.maxsize,
+            **self._stats
+        }
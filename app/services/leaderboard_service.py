@@ -0,0 +1,88 @@
+import heapq
+from typing import List, Optional, Tuple
+
+from ..config.redis import RedisConfig
+from ..database.db import get_top_votes, get_vote_rank
+from .rehydration_service import rehydration_service
+from .vote_shards import vote_shards
+
+
+class LeaderboardService:
+    """排行榜服务，读取投票脚本维护的有序集合，排行榜尚未就绪时从PostgreSQL查询
+
+    票数分片时每个分片有自己的有序集合，查询时合并各分片的结果。
+    """
+
+    MAX_LIMIT = 1000  # 单次查询的最大条数
+
+    def __init__(self):
+        self.redis = RedisConfig.get_redis()
+        self.leaderboard_key = rehydration_service.leaderboard_key
+        self.ready_key = rehydration_service.leaderboard_ready_key
+
+    async def top_voted(self, limit: int = 10, offset: int = 0) -> List[Tuple[str, int]]:
+        """按票数降序返回 [(username, count)]"""
+        limit = max(min(limit, self.MAX_LIMIT), 0)
+        offset = max(offset, 0)
+        if limit == 0:
+            return []
+
+        # 就绪标记与排行榜在同一次往返中读取
+        if not vote_shards.enabled:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.exists(self.ready_key)
+                pipe.zrevrange(self.leaderboard_key, offset, offset + limit - 1, withscores=True)
+                ready, entries = await pipe.execute()
+            if not ready:
+                return await get_top_votes(limit, offset)
+            return [(username, int(score)) for username, score in entries]
+
+        # 每个分片取前offset+limit名，归并后截取
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(vote_shards.count):
+                pipe.exists(vote_shards.key(self.ready_key, shard))
+                pipe.zrevrange(vote_shards.key(self.leaderboard_key, shard), 0, offset + limit - 1, withscores=True)
+            results = await pipe.execute()
+        if not all(results[0::2]):
+            return await get_top_votes(limit, offset)
+        merged = heapq.merge(*results[1::2], key=lambda entry: entry[1], reverse=True)
+        entries = list(merged)[offset:offset + limit]
+        return [(username, int(score)) for username, score in entries]
+
+    async def rank(self, username: str) -> Optional[int]:
+        """返回用户的名次（从1开始），用户不存在时返回None"""
+        if vote_shards.enabled:
+            return await self._sharded_rank(username)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.exists(self.ready_key)
+            pipe.zrevrank(self.leaderboard_key, username)
+            ready, rank = await pipe.execute()
+        if not ready:
+            return await get_vote_rank(username)
+        return rank + 1 if rank is not None else None
+
+    async def _sharded_rank(self, username: str) -> Optional[int]:
+        """名次为各分片中票数高于该用户的人数之和加1，其他分片中同票的用户与其名次相同"""
+        home = vote_shards.shard_of(username)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(vote_shards.count):
+                pipe.exists(vote_shards.key(self.ready_key, shard))
+            pipe.zscore(vote_shards.key(self.leaderboard_key, home), username)
+            pipe.zrevrank(vote_shards.key(self.leaderboard_key, home), username)
+            results = await pipe.execute()
+        if not all(results[:vote_shards.count]):
+            return await get_vote_rank(username)
+        score, home_rank = results[vote_shards.count:]
+        if score is None:
+            return None
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(vote_shards.count):
+                if shard != home:
+                    pipe.zcount(vote_shards.key(self.leaderboard_key, shard), f"({score}", "+inf")
+            higher = await pipe.execute()
+        return home_rank + sum(higher) + 1
+
+
+# 创建单例实例
+leaderboard_service = LeaderboardService()
@@ -0,0 +1,234 @@
+import asyncio
+import os
+import time
+from typing import List
+
+from ..config.redis import RedisConfig
+from ..database.db import iter_vote_batches
+from .vote_shards import vote_shards
+
+
+class RehydrationService:
+    """从PostgreSQL恢复Redis中的票数（user_votes、排行榜）和全局版本号（vote_version）
+
+    Redis中的就绪标记（vote_state_ready）表示票数数据完整：
+    - 标记不存在时投票脚本拒绝写入，查询回退到PostgreSQL
+    - 多个实例同时启动时通过锁保证只有一个实例执行恢复，其余实例等待标记出现
+    - 已有vote_version（例如升级前已在运行的集群）说明Redis数据完好，直接设置标记
+    票数分片时每个分片有自己的一组键和就绪标记，恢复时按用户名分配到各分片，
+    各分片的版本号都从数据库中的最大版本号开始；只恢复缺少就绪标记且数据已丢失的分片。
+    主服务运行期间持续检查就绪标记（投票或查询发现标记缺失时立即检查），
+    Redis在服务运行中丢失数据时自动重新恢复，不需要重启或手动执行。
+    """
+
+    def __init__(self):
+        self.redis = RedisConfig.get_redis()
+        self.ready_key = "vote_state_ready"
+        self.lock_key = "vote_rehydration_lock"
+        self.user_votes_key = "user_votes"
+        self.vote_version_key = "vote_version"
+        self.leaderboard_key = "vote_leaderboard"  # 按总票数排序的有序集合，由投票脚本维护
+        self.leaderboard_ready_key = "vote_leaderboard_ready"  # 排行榜包含所有用户
+        self.leaderboard_lock_key = "vote_leaderboard_lock"
+        # 从环境变量获取配置，如果没有则使用默认值
+        self.batch_size = int(os.getenv("VOTE_REHYDRATE_BATCH_SIZE", "5000"))  # 每次管道写入的用户数
+        self.startup_timeout = float(os.getenv("VOTE_REHYDRATE_STARTUP_TIMEOUT", "5"))  # 启动时最长等待时间（秒）
+        self.lock_ttl = int(os.getenv("VOTE_REHYDRATE_LOCK_TTL", "60"))  # 恢复锁过期时间（秒），每批写入后续期
+        self.watch_interval = float(os.getenv("VOTE_REHYDRATE_WATCH_INTERVAL", "5"))  # 检查就绪标记的间隔（秒）
+        self._task = None
+        self._ready_once = None  # 本进程启动后首次就绪
+        self._wake = None  # 发现就绪标记缺失时立即检查
+        self._stats = {
+            "state": "unknown",
+            "users": 0,
+            "max_version": 0,
+            "duration_ms": 0
+        }
+
+    async def is_ready(self) -> bool:
+        """Redis中所有分片的票数是否完整"""
+        return not await self._missing_shards(self.ready_key)
+
+    async def _all_exist(self, name: str) -> bool:
+        """所有分片中的键是否都存在"""
+        return not await self._missing_shards(name)
+
+    async def _missing_shards(self, name: str) -> List[int]:
+        """缺少该键的分片（集群中不同分片的键不能在一条EXISTS中查询）"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in vote_shards.keys(name):
+                pipe.exists(key)
+            return [shard for shard, exists in enumerate(await pipe.execute()) if not exists]
+
+    async def _set_all(self, name: str, value, shards: List[int] = None):
+        """在所有（或指定的）分片中设置键"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(vote_shards.count) if shards is None else shards:
+                pipe.set(vote_shards.key(name, shard), value)
+            await pipe.execute()
+
+    async def start(self):
+        """启动后台恢复与检查任务，最多等待startup_timeout秒，超时后恢复继续在后台进行，不阻塞服务启动"""
+        self._ready_once = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self.watch())
+        try:
+            await asyncio.wait_for(self._ready_once.wait(), timeout=self.startup_timeout)
+        except asyncio.TimeoutError:
+            print(f"Vote rehydration still running after {self.startup_timeout}s, reads fall back to PostgreSQL")
+
+    def notify_not_ready(self):
+        """投票或查询发现就绪标记缺失（例如Redis丢失了数据），唤醒后台任务立即检查"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def watch(self):
+        """恢复Redis中的票数，之后定期检查就绪标记，标记缺失时重新恢复"""
+        while True:
+            await self.run_until_ready()
+            self._ready_once.set()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.watch_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def stop(self):
+        """停止后台恢复任务"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def run_until_ready(self):
+        """反复尝试直到Redis中的票数就绪"""
+        while True:
+            try:
+                await self.ensure_rehydrated()
+                await self.ensure_leaderboard()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["state"] = "failed"
+                print(f"Error rehydrating votes from PostgreSQL, will retry: {e}")
+                await asyncio.sleep(5)
+
+    async def ensure_rehydrated(self):
+        """确保Redis中的票数就绪，必要时从PostgreSQL恢复缺少就绪标记的分片"""
+        if await self.is_ready():
+            self._stats["state"] = "ready"
+            return
+        print("Vote state ready marker missing, checking Redis votes...")
+
+        if not await self.redis.set(self.lock_key, "1", nx=True, ex=self.lock_ttl):
+            # 其他实例正在恢复，等待其完成；锁过期说明该实例已退出，重新竞争
+            self._stats["state"] = "waiting"
+            while not await self.is_ready():
+                if not await self.redis.exists(self.lock_key):
+                    return await self.ensure_rehydrated()
+                await asyncio.sleep(0.5)
+            self._stats["state"] = "ready"
+            return
+
+        try:
+            missing = await self._missing_shards(self.ready_key)
+            lost = set(await self._missing_shards(self.vote_version_key))
+            intact = [shard for shard in missing if shard not in lost]
+            if intact:
+                # 这些分片的数据完好，只是缺少就绪标记
+                await self._set_all(self.ready_key, "1", intact)
+            lost_missing = [shard for shard in missing if shard in lost]
+            if lost_missing:
+                await self.rehydrate(lost_missing)
+            else:
+                self._stats["state"] = "ready"
+        finally:
+            await self.redis.delete(self.lock_key)
+
+    async def rehydrate(self, shards: List[int] = None):
+        """流式读取votes表，分批管道写入user_votes，最后恢复vote_version并设置就绪标记
+
+        shards为需要恢复的分片（默认全部），其余分片中的票数保持不变。
+        """
+        shards = list(range(vote_shards.count)) if shards is None else shards
+        self._stats["state"] = "rehydrating"
+        start_time = time.monotonic()
+        users = 0
+        max_version = 0
+        print(f"Rehydrating Redis votes from PostgreSQL (shards {shards})...")
+
+        async for rows in iter_vote_batches(self.batch_size):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for shard, indices in vote_shards.group([row[0] for row in rows]).items():
+                    if shard not in shards:
+                        continue
+                    users += len(indices)
+                    counts = {rows[i][0]: rows[i][1] for i in indices}
+                    pipe.hset(vote_shards.key(self.user_votes_key, shard), mapping=counts)
+                    pipe.zadd(vote_shards.key(self.leaderboard_key, shard), counts)
+                pipe.expire(self.lock_key, self.lock_ttl)
+                await pipe.execute()
+            max_version = max(max_version, max(version for _, _, version in rows))
+            self._stats["users"] = users
+
+        # 新的投票从数据库中最大的版本号之后继续编号，消费者的版本比较才能生效
+        # 同一分片的键位于同一节点，版本号总是先于就绪标记写入
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in shards:
+                pipe.set(vote_shards.key(self.vote_version_key, shard), max_version)
+                pipe.set(vote_shards.key(self.ready_key, shard), "1")
+                pipe.set(vote_shards.key(self.leaderboard_ready_key, shard), "1")
+            await pipe.execute()
+
+        duration_ms = (time.monotonic() - start_time) * 1000
+        self._stats.update(state="ready", max_version=max_version, duration_ms=round(duration_ms, 1))
+        print(f"Rehydrated {users} users (vote_version={max_version}) in {duration_ms:.0f}ms")
+
+    async def ensure_leaderboard(self):
+        """排行榜引入之前已有的用户不在有序集合中，扫描user_votes补齐
+
+        使用ZADD NX，投票脚本期间写入的分数（总是最新的总票数）不会被扫描到的旧值覆盖。
+        """
+        if await self._all_exist(self.leaderboard_ready_key):
+            return
+        if not await self.redis.set(self.leaderboard_lock_key, "1", nx=True, ex=self.lock_ttl):
+            # 其他实例正在构建，排行榜查询暂时由PostgreSQL提供
+            return
+
+        try:
+            print("Building vote leaderboard from user_votes...")
+            users = 0
+            for shard in range(vote_shards.count):
+                async for chunk in self._scan_user_votes(shard):
+                    async with self.redis.pipeline(transaction=False) as pipe:
+                        pipe.zadd(vote_shards.key(self.leaderboard_key, shard),
+                                  {username: int(count) for username, count in chunk}, nx=True)
+                        pipe.expire(self.leaderboard_lock_key, self.lock_ttl)
+                        await pipe.execute()
+                    users += len(chunk)
+            await self._set_all(self.leaderboard_ready_key, "1")
+            print(f"Vote leaderboard built with {users} users")
+        finally:
+            await self.redis.delete(self.leaderboard_lock_key)
+
+    async def _scan_user_votes(self, shard: int = 0):
+        """按HSCAN分块遍历一个分片的user_votes"""
+        cursor = 0
+        while True:
+            cursor, fields = await self.redis.hscan(
+                vote_shards.key(self.user_votes_key, shard), cursor, count=self.batch_size)
+            if fields:
+                yield list(fields.items())
+            if cursor == 0:
+                return
+
+    def get_stats(self) -> dict:
+        """获取恢复状态"""
+        return dict(self._stats)
+
+
+# 创建单例实例
+rehydration_service = RehydrationService()
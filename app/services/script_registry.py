@@ -0,0 +1,74 @@
+import hashlib
+import time
+from typing import Dict, List, Optional
+
+from redis.exceptions import NoScriptError
+
+from ..config.redis import RedisConfig
+
+
+class ScriptRegistry:
+    """Lua脚本注册表：启动时统一加载脚本，运行时通过EVALSHA按SHA调用"""
+
+    def __init__(self):
+        self.redis = RedisConfig.get_redis()
+        self._sources: Dict[str, str] = {}
+        self._shas: Dict[str, str] = {}
+        self._stats: Dict[str, dict] = {}
+
+    def register(self, name: str, source: str) -> str:
+        """注册Lua脚本，返回脚本的SHA1（与Redis SCRIPT LOAD计算方式一致）"""
+        sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        self._sources[name] = source
+        self._shas[name] = sha
+        self._stats.setdefault(name, {
+            "calls": 0,
+            "errors": 0,
+            "reloads": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0
+        })
+        return sha
+
+    async def load_all(self):
+        """将所有已注册的脚本加载到Redis脚本缓存中"""
+        for name, source in self._sources.items():
+            self._shas[name] = await self.redis.script_load(source)
+
+    async def evalsha(self, name: str, keys: List[str], args: Optional[list] = None):
+        """按名称执行脚本，Redis重启导致脚本丢失时（NOSCRIPT）自动重新加载后重试"""
+        stats = self._stats[name]
+        start = time.perf_counter()
+        try:
+            try:
+                return await self.redis.evalsha(self._shas[name], len(keys), *keys, *(args or []))
+            except NoScriptError:
+                stats["reloads"] += 1
+                self._shas[name] = await self.redis.script_load(self._sources[name])
+                return await self.redis.evalsha(self._shas[name], len(keys), *keys, *(args or []))
+        except Exception:
+            stats["errors"] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    def get_stats(self) -> Dict[str, dict]:
+        """获取每个脚本的调用次数与延迟统计"""
+        return {
+            name: {
+                "sha": self._shas[name],
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "reloads": stats["reloads"],
+                "avg_ms": stats["total_ms"] / stats["calls"] if stats["calls"] else 0.0,
+                "max_ms": stats["max_ms"]
+            }
+            for name, stats in self._stats.items()
+        }
+
+
+# 创建单例实例
+script_registry = ScriptRegistry()
@@ -1,22 +1,26 @@
 import asyncio
-import hmac
-import hashlib
+import json
 import time
 from datetime import datetime
-import json
 from ..config.redis import RedisConfig
+from ..config.ticket import TicketConfig
 
 
 class TicketGeneratorService:
     """专门负责生成票据的服务，设计为以单实例方式部署"""
 
     def __init__(self):
-        self.secret_key = b'cast_secret_key'  # HMAC密钥
         self.redis = RedisConfig.get_redis()
         self.ticket_key_prefix = "ticket:"
+        self.ticket_channel = "ticket_updates"  # 新票据的发布频道，主服务订阅后在内存中保存当前票据
 
     async def start_ticket_generator(self):
-        """启动票据生成器，每2秒生成一个新票据"""
+        """启动票据生成器
+
+        按墙钟时间划分长度为有效期的时间槽，每个时间槽对应一个票据，
+        在时间槽结束前overlap毫秒提前发布下一个票据，到达边界时切换为当前票据。
+        唤醒时间按时间槽边界计算，不会随sleep累积漂移。
+        """
         while True:
             try:
                 result = await self.generate_new_ticket()
@@ -25,49 +29,73 @@ class TicketGeneratorService:
                     print(f"票据生成失败，将在1秒后重试: {result['error']}")
                     await asyncio.sleep(1)  # 错误后较短重试时间
                     continue
-                # 正常情况，每2秒生成一次
-                await asyncio.sleep(2)
+                # 等待到下一次发布时间（提前发布下一个票据或切换当前票据）
+                await asyncio.sleep(self.seconds_until_next_change())
             except Exception as e:
                 # 捕获其他未预期的错误
                 print(f"票据生成器遇到意外错误: {str(e)}")
                 await asyncio.sleep(1)  # 错误后较短重试时间
 
+    @staticmethod
+    def get_slot_times(now):
+        """返回当前时间槽的开始时间、下一个时间槽的开始时间和下一个票据的发布时间（秒）"""
+        slot_start = int(now // TicketConfig.VALID_DURATION) * TicketConfig.VALID_DURATION
+        next_start = slot_start + TicketConfig.VALID_DURATION
+        return slot_start, next_start, next_start - TicketConfig.OVERLAP_MS / 1000
+
+    def seconds_until_next_change(self):
+        """距离下一次发布的时间（秒）"""
+        now = time.time()
+        _, next_start, prepublish_at = self.get_slot_times(now)
+        wake_at = prepublish_at if now < prepublish_at else next_start
+        return max(wake_at - now, 0.001)
+
     async def generate_new_ticket(self):
-        """生成新票据，使用HMAC配合时间戳"""
-        timestamp = int(time.time())
-        # 创建HMAC，使用时间戳作为消息
-        h = hmac.new(self.secret_key, str(timestamp).encode(), hashlib.sha256)
-        ticket_id = h.hexdigest()
-
-        # 计算过期时间（2秒后）
-        expires_at = datetime.fromtimestamp(timestamp + 2).isoformat()
-
-        # 将票据信息存储到Redis中
-        ticket_info = {
-            "id": ticket_id,
-            "expiresAt": expires_at,
-            "usageCount": 0,
-            "createdAt": datetime.fromtimestamp(timestamp).isoformat()
-        }
+        """发布当前时间槽的票据，处于提前发布窗口时同时发布下一个时间槽的票据
+
+        票据ID由时间槽的开始时间确定，同一时间槽重复发布得到相同的票据，使用次数不会被重置。
+        """
+        now = time.time()
+        slot_start, next_start, prepublish_at = self.get_slot_times(now)
+        # 票据ID携带签发时间戳和HMAC签名，主服务无需访问Redis即可校验
+        current = self.build_ticket(slot_start)
+        next_ticket = self.build_ticket(next_start) if now >= prepublish_at else None
 
         try:
             # 使用管道确保原子操作
             pipe = self.redis.pipeline()
 
-            # 存储新票据信息
-            pipe.set(f"{self.ticket_key_prefix}{ticket_id}",
-                     json.dumps(ticket_info))
+            for ticket in filter(None, (current, next_ticket)):
+                # 存储票据信息（紧凑的Hash形式，使用次数通过HINCRBY原地更新）
+                ticket_key = f"{self.ticket_key_prefix}{ticket['id']}"
+                pipe.hset(ticket_key, mapping={
+                    "expiresAtMs": ticket["expiresAtMs"],
+                    "createdAtMs": ticket["createdAtMs"]
+                })
+                pipe.hsetnx(ticket_key, "usageCount", 0)
+                # 过期后再保留3秒，确保边界附近的请求仍能读到票据
+                pipe.expireat(ticket_key, ticket["expiresAtMs"] // 1000 + 3)
 
-            # 更新当前有效票据
-            pipe.set("current_ticket", ticket_id)
+            # 更新当前有效票据和下一个票据
+            pipe.set("current_ticket", current["id"])
+            if next_ticket:
+                pipe.set("next_ticket", next_ticket["id"])
+            else:
+                pipe.delete("next_ticket")
 
-            # 设置过期时间（稍大于2秒，确保在新票据生成前不过期）
-            pipe.expire(f"{self.ticket_key_prefix}{ticket_id}", 5)
+            # 推送票据，主服务据此更新内存中的当前票据和下一个票据
+            pipe.publish(self.ticket_channel, json.dumps({"current": current, "next": next_ticket}))
 
             # 执行所有操作
-            pipe.execute()
+            await pipe.execute()
 
-            return ticket_info
+            return {
+                "id": current["id"],
+                "expiresAt": datetime.fromtimestamp(current["expiresAtMs"] / 1000).isoformat(),
+                "usageCount": 0,
+                "createdAt": datetime.fromtimestamp(slot_start).isoformat(),
+                "next": next_ticket["id"] if next_ticket else None
+            }
         except Exception as e:
             # 记录错误并返回详细信息
             error_msg = f"Redis连接错误: {str(e)}"
@@ -76,6 +104,15 @@ class TicketGeneratorService:
             # logger.error(error_msg)
             return {"error": error_msg, "status": "failed"}
 
+    @staticmethod
+    def build_ticket(timestamp):
+        """生成时间槽对应的票据，过期时间以毫秒时间戳存储，供Lua脚本直接与Redis TIME比较"""
+        return {
+            "id": TicketConfig.sign(timestamp),
+            "expiresAtMs": (timestamp + TicketConfig.VALID_DURATION) * 1000,
+            "createdAtMs": timestamp * 1000
+        }
+
 
 # 创建单例实例
 ticket_generator_service = TicketGeneratorService()
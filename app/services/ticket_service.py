@@ -1,25 +1,123 @@
-import hmac
-import hashlib
+import asyncio
+import json
 import time
 from datetime import datetime
-import json
 from ..config.redis import RedisConfig
+from ..config.ticket import TicketConfig
+from .script_registry import script_registry
+
+# Lua片段：原子化地检查并消耗一次票据使用次数，校验失败时返回错误信息，成功时返回nil
+# 票据以Hash存储（expiresAtMs为毫秒级过期时间戳，usageCount为使用计数），
+# 过期判断以Redis服务器的TIME为准，避免JSON编解码和整值重写
+# 票据校验脚本与投票脚本共用此片段，保证校验逻辑只有一份
+CONSUME_TICKET_LUA = """
+local function consume_ticket(ticket_key, max_usage_limit)
+    -- 获取票据信息
+    local ticket_info = redis.call('HMGET', ticket_key, 'expiresAtMs', 'usageCount')
+
+    -- 检查票据是否存在
+    if not ticket_info[1] then
+        return "Invalid ticket"
+    end
+
+    -- 检查使用次数是否超过限制
+    if tonumber(ticket_info[2]) >= max_usage_limit then
+        return "Ticket usage limit exceeded"
+    end
+
+    -- 检查票据是否过期
+    local now = redis.call('TIME')
+    local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    if now_ms > tonumber(ticket_info[1]) then
+        return "Ticket expired"
+    end
+
+    -- 验证通过，更新使用次数
+    redis.call('HINCRBY', ticket_key, 'usageCount', 1)
+    return nil
+end
+"""
+
+# Lua脚本，实现原子化的获取、验证和更新操作
+VALIDATE_TICKET_SCRIPT = CONSUME_TICKET_LUA + """
+local error_message = consume_ticket(KEYS[1], tonumber(ARGV[1]))
+if error_message then
+    return {0, error_message}
+end
+return {1, "Ticket valid"}
+"""
+
+# Lua脚本，退回一次票据使用次数（票据已删除或使用次数为0时忽略）
+REFUND_TICKET_SCRIPT = """
+if tonumber(redis.call('HGET', KEYS[1], 'usageCount') or '0') > 0 then
+    redis.call('HINCRBY', KEYS[1], 'usageCount', -1)
+end
+return 1
+"""
 
 
 class TicketService:
     def __init__(self):
         self.max_usage_limit = 100  # 票据使用上限
-        self.secret_key = b'cast_secret_key'  # HMAC密钥，保留用于验证
         self.redis = RedisConfig.get_redis()
         self.ticket_key_prefix = "ticket:"
         self.user_votes_key = "user_votes:"
         self.user_ticket_key = "user_ticket:"
         self.vote_queue_key = "vote_queue"
+        self.ticket_channel = "ticket_updates"  # 票据生成器推送新票据的频道
+        script_registry.register("validate_ticket", VALIDATE_TICKET_SCRIPT)
+        script_registry.register("refund_ticket", REFUND_TICKET_SCRIPT)
+
+        # 订阅推送的当前票据和下一个票据，订阅期间cas无需访问Redis
+        self._tickets = None  # {"current": {"id", "expiresAtMs"}, "next": {"id", "expiresAtMs"} 或 None}
+        self._subscribed = False
+        self._subscriber = None
 
     async def get_current_ticket(self):
-        """获取当前有效票据"""
-        # 获取当前票据ID
-        current_ticket_id = self.redis.get("current_ticket")
+        """获取当前有效票据和已提前发布的下一个票据
+
+        优先使用推送到内存中的票据，未订阅或票据均已过期时查询Redis。
+        """
+        self._ensure_subscriber()
+        if self._subscribed and self._tickets is not None:
+            result = self._get_pushed_tickets()
+            if result is not None:
+                return result
+            # 票据均已过期（例如生成器停止），丢弃后回退到查询Redis
+            self._tickets = None
+
+        result = await self._poll_current_ticket()
+        if self._subscribed and self._tickets is None and result["id"]:
+            # 刚订阅还未收到推送时，用查询到的票据填充内存，之后的推送会覆盖它
+            next_ticket = result["next"]
+            self._tickets = {
+                "current": {"id": result["id"], "expiresAtMs": result["expiresAtMs"]},
+                "next": {"id": next_ticket["id"], "expiresAtMs": next_ticket["expiresAtMs"]} if next_ticket else None
+            }
+        return result
+
+    def _get_pushed_tickets(self):
+        """从内存中的推送票据构造结果，当前票据过期时由下一个票据接替，都已过期时返回None"""
+        now_ms = time.time() * 1000
+        current, next_ticket = self._tickets["current"], self._tickets["next"]
+        if now_ms >= current["expiresAtMs"]:
+            if next_ticket is None or now_ms >= next_ticket["expiresAtMs"]:
+                return None
+            current, next_ticket = next_ticket, None
+
+        # 推送的票据不包含实时使用次数
+        result = self._format_ticket(current["id"], current["expiresAtMs"], 0)
+        result["next"] = self._format_ticket(next_ticket["id"], next_ticket["expiresAtMs"], 0) if next_ticket else None
+        return result
+
+    async def _poll_current_ticket(self):
+        """从Redis查询当前票据和下一个票据"""
+        # 获取当前票据ID和提前发布的下一个票据ID
+        # 两个键在集群中可能位于不同的slot，不使用MGET
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get("current_ticket")
+            pipe.get("next_ticket")
+            current_ticket_id, next_ticket_id = await pipe.execute()
 
         if not current_ticket_id:
             # 如果没有当前票据，返回错误信息
@@ -27,77 +125,100 @@ class TicketService:
                 "id": "",
                 "expiresAt": "",
                 "usageCount": 0,
+                "next": None,
                 "error": "No active ticket available"
             }
 
         # 获取票据详细信息
-        ticket_info_json = self.redis.get(
-            f"{self.ticket_key_prefix}{current_ticket_id}")
-        if not ticket_info_json:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(self.get_ticket_key(current_ticket_id), "expiresAtMs", "usageCount")
+            if next_ticket_id:
+                pipe.hmget(self.get_ticket_key(next_ticket_id), "expiresAtMs", "usageCount")
+            tickets = await pipe.execute()
+
+        expires_at_ms, usage_count = tickets[0]
+        if expires_at_ms is None:
             # 票据信息不存在，返回错误
             return {
                 "id": "",
                 "expiresAt": "",
                 "usageCount": 0,
+                "next": None,
                 "error": "Ticket information not found"
             }
 
-        ticket_info = json.loads(ticket_info_json)
+        result = self._format_ticket(current_ticket_id, int(expires_at_ms), int(usage_count or 0))
+        result["next"] = None
+        if next_ticket_id and tickets[1][0] is not None:
+            result["next"] = self._format_ticket(next_ticket_id, int(tickets[1][0]), int(tickets[1][1] or 0))
+        return result
+
+    @staticmethod
+    def _format_ticket(ticket_id, expires_at_ms, usage_count):
         return {
-            "id": ticket_info["id"],
-            "expiresAt": ticket_info["expiresAt"],
-            "usageCount": ticket_info.get("usageCount", 0)
+            "id": ticket_id,
+            "expiresAt": datetime.fromtimestamp(expires_at_ms / 1000).isoformat(),
+            "expiresAtMs": expires_at_ms,
+            "usageCount": usage_count
         }
 
+    def _ensure_subscriber(self):
+        """按需启动后台订阅任务"""
+        if self._subscriber is None or self._subscriber.done():
+            self._subscriber = asyncio.create_task(self._run_subscriber())
+
+    async def _run_subscriber(self):
+        """订阅票据推送频道，断开期间丢弃内存中的票据并回退到查询Redis"""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.ticket_channel)
+                async for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        self._subscribed = True
+                    elif message["type"] == "message":
+                        tickets = json.loads(message["data"])
+                        self._tickets = {"current": tickets["current"], "next": tickets["next"]}
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ticket subscription lost, falling back to polling: {e}")
+            finally:
+                self._subscribed = False
+                self._tickets = None
+                await pubsub.aclose()
+            await asyncio.sleep(1)
+
+    async def close(self):
+        """停止后台订阅任务"""
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            try:
+                await self._subscriber
+            except asyncio.CancelledError:
+                pass
+            self._subscriber = None
+
+    def get_ticket_key(self, ticket):
+        """获取票据在Redis中的键"""
+        return f"{self.ticket_key_prefix}{ticket}"
+
+    def pre_verify_ticket(self, ticket):
+        """在本地校验票据签名和有效期，伪造、格式错误或已过期的票据无需访问Redis即被拒绝"""
+        return TicketConfig.verify(ticket)
+
     async def validate_ticket(self, ticket):
         """验证票据是否有效，使用Lua脚本确保原子性"""
-        # 定义Lua脚本，实现原子化的获取、验证和更新操作
-        validate_script = """
-        local ticket_key = KEYS[1]
-        local max_usage_limit = tonumber(ARGV[1])
-        local current_time = ARGV[2]
-        
-        -- 获取票据信息
-        local ticket_info_json = redis.call('GET', ticket_key)
-        
-        -- 检查票据是否存在
-        if not ticket_info_json then
-            return {0, "Invalid ticket"}
-        end
-        
-        -- 解析票据信息（在Lua中解析JSON）
-        local ticket_info = cjson.decode(ticket_info_json)
-        
-        -- 检查使用次数是否超过限制
-        if ticket_info["usageCount"] >= max_usage_limit then
-            return {0, "Ticket usage limit exceeded"}
-        end
-        
-        -- 检查票据是否过期
-        if current_time > ticket_info["expiresAt"] then
-            return {0, "Ticket expired"}
-        end
-        
-        -- 验证通过，更新使用次数
-        ticket_info["usageCount"] = ticket_info["usageCount"] + 1
-        
-        -- 更新票据信息
-        redis.call('SET', ticket_key, cjson.encode(ticket_info))
-        
-        return {1, "Ticket valid"}
-        """
+        # 先在本地校验签名，Redis只负责使用次数计数
+        error_message = self.pre_verify_ticket(ticket)
+        if error_message:
+            return False, error_message
 
-        # 准备脚本参数
-        ticket_key = f"{self.ticket_key_prefix}{ticket}"
-        current_time = datetime.now().isoformat()
-
-        # 执行Lua脚本
-        result = self.redis.eval(
-            validate_script,
-            1,  # 1个KEYS参数
-            ticket_key,  # KEYS[1]
-            self.max_usage_limit,  # ARGV[1]
-            current_time  # ARGV[2]
+        # 通过EVALSHA执行预加载的Lua脚本
+        result = await script_registry.evalsha(
+            "validate_ticket",
+            [self.get_ticket_key(ticket)],  # KEYS[1]
+            [self.max_usage_limit]  # ARGV[1]
         )
 
         # 解析结果
@@ -106,10 +227,13 @@ class TicketService:
 
         return is_valid, message
 
+    async def refund_ticket(self, ticket):
+        """退回validate_ticket消耗的一次使用次数，用于票据已消耗但投票未能完成的情况"""
+        await script_registry.evalsha("refund_ticket", [self.get_ticket_key(ticket)])
 
-    def get_user_votes(self, username):
+    async def get_user_votes(self, username):
         """获取用户的票数"""
-        votes = self.redis.hget("user_votes", username)
+        votes = await self.redis.hget("user_votes", username)
         if votes is None:
             return 0
         return int(votes)
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+from ..config.redis import RedisConfig
+
+
+class VoteCache:
+    """进程内票数读缓存，容量有界，按LRU淘汰
+
+    投票脚本在写入后通过pub/sub频道发布更新后的票数，后台订阅任务据此更新已缓存的用户，
+    订阅断开期间不使用缓存（并清空已缓存的数据）。
+    每个缓存项最多使用max_staleness_ms毫秒，即使漏掉了更新消息，读到的票数也不会比这更旧。
+    skip对其返回True的用户（存在未合并条带的热点用户）收到更新消息时移出缓存，更新消息中的总票数不包含条带。
+    """
+
+    def __init__(self, skip: Callable[[str], bool] = None):
+        self.redis = RedisConfig.get_redis()
+        self.skip = skip
+        # 从环境变量获取配置，如果没有则使用默认值
+        self.enabled = os.getenv("VOTE_CACHE_ENABLED", "false").lower() == "true"
+        self.maxsize = int(os.getenv("VOTE_CACHE_SIZE", "10000"))
+        self.max_staleness = float(os.getenv("VOTE_CACHE_MAX_STALENESS_MS", "1000")) / 1000
+        self.channel = os.getenv("VOTE_CACHE_CHANNEL", "vote_updates")
+
+        self._entries = OrderedDict()  # {username: (票数, 写入时间)}
+        self._subscribed = False
+        self._subscriber = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0,
+            "updates": 0
+        }
+
+    def get_many(self, usernames: List[str]) -> Dict[str, int]:
+        """返回已缓存且未过期的用户票数，未命中的用户不在结果中"""
+        self._ensure_subscriber()
+        if not self._subscribed:
+            self._stats["misses"] += len(usernames)
+            return {}
+
+        now = time.monotonic()
+        found = {}
+        for username in usernames:
+            entry = self._entries.get(username)
+            if entry is None:
+                self._stats["misses"] += 1
+            elif now - entry[1] > self.max_staleness:
+                del self._entries[username]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+            else:
+                self._entries.move_to_end(username)
+                found[username] = entry[0]
+                self._stats["hits"] += 1
+        return found
+
+    def put_many(self, votes: Dict[str, int]):
+        """缓存从Redis读取的票数"""
+        if not self._subscribed:
+            return
+        now = time.monotonic()
+        for username, count in votes.items():
+            self._entries[username] = (count, now)
+            self._entries.move_to_end(username)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def _apply_update(self, usernames: List[str], votes: List[int]):
+        """根据投票脚本发布的消息更新已缓存的用户（未缓存的用户不加入缓存）"""
+        now = time.monotonic()
+        for username, count in zip(usernames, votes):
+            if self.skip is not None and self.skip(username):
+                self._entries.pop(username, None)
+            elif username in self._entries:
+                self._entries[username] = (count, now)
+                self._stats["updates"] += 1
+
+    def _ensure_subscriber(self):
+        """按需启动后台订阅任务"""
+        if self._subscriber is None or self._subscriber.done():
+            self._subscriber = asyncio.create_task(self._run_subscriber())
+
+    async def _run_subscriber(self):
+        """订阅票数更新频道，断开后清空缓存并重连"""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        # 订阅建立后才开始缓存，之前读到的票数不会错过更新
+                        self._subscribed = True
+                    elif message["type"] == "message":
+                        update = json.loads(message["data"])
+                        self._apply_update(update["usernames"], update["votes"] or [])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Vote cache subscription lost, cache disabled until reconnected: {e}")
+            finally:
+                self._subscribed = False
+                self._entries.clear()
+                await pubsub.aclose()
+            await asyncio.sleep(1)
+
+    async def close(self):
+        """停止后台订阅任务"""
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            try:
+                await self._subscriber
+            except asyncio.CancelledError:
+                pass
+            self._subscriber = None
+
+    def get_stats(self) -> dict:
+        """获取命中、未命中和淘汰计数"""
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "subscribed": self._subscribed,
+            "size": len(self._entries),
+            "capacity": self.maxsize,
+            "hit_ratio": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            **self._stats
+        }
@@ -1,10 +1,188 @@
+import asyncio
 import json
+import os
 from typing import List
 import time
+from datetime import datetime, timedelta, timezone
 
-from ..services.ticket_service import ticket_service
+from ..services.ticket_service import ticket_service, CONSUME_TICKET_LUA
 from ..config.redis import RedisConfig
 from ..config.kafka import KafkaConfig
+from .script_registry import script_registry
+from .event_queue import VoteEventQueue, EventQueueFullError
+from .rehydration_service import rehydration_service
+from .vote_cache import VoteCache
+from .vote_shards import vote_shards
+from .vote_stripes import VoteStripes
+from ..models.vote_event import encode_vote_events
+from ..database.db import get_vote_count, get_votes_by_usernames, query_vote_events
+
+# Lua脚本，在一次往返中原子性地完成参数检查、票据校验和投票
+# ARGV[2]为投票请求列表，按顺序逐个处理，每个请求独立校验票据并获得自己的版本号，
+# 单个请求即长度为1的列表，合并提交时一次调用处理整批请求
+# ARGV[3]为发件箱Stream的积压上限，大于0时投票事件与计数更新在同一脚本内原子写入发件箱；
+# 发件箱不按长度裁剪（裁剪会丢弃尚未转发的事件），积压达到上限时拒绝新的投票，合并与撤销请求除外
+# ARGV[4]为票数更新频道，非空时发布本次调用更新后的票数，供各进程的读缓存同步
+# KEYS[5]为就绪标记，Redis中的票数尚未从PostgreSQL恢复时拒绝所有请求，避免在空数据上累加
+# KEYS[6]为排行榜有序集合，每次更新后以用户的总票数作为分数写入
+# ARGV[7]为1时票据已由调用方消耗（票数分片模式下票据与分片不在同一个slot），脚本不再校验票据
+# KEYS[2]为投票审计Stream，传入投票人时每个目标用户一条记录，按ARGV[5]（MAXLEN）和ARGV[6]（保留毫秒数，MINID）裁剪
+# KEYS[7]为热点用户的条带计数器，请求中的stripes与usernames一一对应，非空时该用户的票数只写入该条带字段，
+# 返回的votes中对应位置为条带字段更新后的值，脚本不读取条带（包含条带的票数由调用方在脚本之外读取）
+# KEYS[8]为每个条带已合并的序号，请求中带有fold时表示合并条带中取出的票数，序号已合并过的请求直接跳过
+# 写入发件箱、发布和返回的totals只包含总票数有变化的用户，与Kafka中的事件一致
+VOTE_SCRIPT = CONSUME_TICKET_LUA + """
+local user_votes_key = KEYS[1]
+local vote_audit_key = KEYS[2]
+local vote_version_key = KEYS[3]
+local outbox_key = KEYS[4]
+local ready_key = KEYS[5]
+local leaderboard_key = KEYS[6]
+local stripes_key = KEYS[7]
+local stripe_applied_key = KEYS[8]
+local max_usage_limit = tonumber(ARGV[1])
+local requests = cjson.decode(ARGV[2])
+local outbox_maxlen = tonumber(ARGV[3])
+local update_channel = ARGV[4]
+local audit_maxlen = tonumber(ARGV[5])
+local audit_retention_ms = tonumber(ARGV[6])
+local tickets_consumed = ARGV[7] == '1'
+local audit_written = false
+
+local function apply_vote(ticket_key, request)
+    local usernames = request["usernames"]
+    local vote_counts = request["votes"]
+    local voter_username = request["voter"]
+    local stripe_fields = request["stripes"] or {}
+
+    -- 先检查参数，避免无效请求消耗票据使用次数
+    if #usernames ~= #vote_counts then
+        return {success = false, message = "Vote count list must have the same length as usernames list"}
+    end
+
+    -- 转发落后时拒绝投票而不是裁剪发件箱，在消耗票据之前检查
+    if outbox_maxlen > 0 and not request["fold"] and not request["undo"]
+            and redis.call('XLEN', outbox_key) >= outbox_maxlen then
+        return {success = false, message = "Vote service is overloaded, please retry later"}
+    end
+
+    -- 校验并消耗票据
+    if not tickets_consumed then
+        local error_message = consume_ticket(ticket_key, max_usage_limit)
+        if error_message then
+            return {success = false, message = error_message}
+        end
+    end
+
+    -- 条带合并按序号去重，重试的合并不会重复计数
+    local fold = request["fold"]
+    if fold then
+        local applied = tonumber(redis.call('HGET', stripe_applied_key, fold["field"]) or '0')
+        if applied >= fold["seq"] then
+            return {success = true, duplicate = true}
+        end
+        redis.call('HSET', stripe_applied_key, fold["field"], fold["seq"])
+    end
+
+    -- 增加全局投票版本号
+    local current_version = redis.call('INCR', vote_version_key)
+
+    -- 返回给调用方的票数，以及写入发件箱的总票数（不含条带的用户）
+    local result_votes = {}
+    local reported_usernames = {}
+    local reported_votes = {}
+
+    for i, username in ipairs(usernames) do
+        local stripe_field = stripe_fields[i] or ''
+        if stripe_field ~= '' then
+            -- 热点用户的票数写入条带，由后台任务合并到总票数，不更新排行榜和发件箱
+            table.insert(result_votes, redis.call('HINCRBY', stripes_key, stripe_field, vote_counts[i]))
+        else
+            -- HINCRBY直接返回更新后的总票数
+            local updated_votes = redis.call('HINCRBY', user_votes_key, username, vote_counts[i])
+            table.insert(result_votes, updated_votes)
+            table.insert(reported_usernames, username)
+            table.insert(reported_votes, updated_votes)
+            -- 写入总票数而不是增量，排行榜中的分数始终与user_votes一致
+            redis.call('ZADD', leaderboard_key, updated_votes, username)
+        end
+
+        -- 如果有投票人信息，记录投票行为，由audit_writer批量写入PostgreSQL
+        if voter_username ~= '' then
+            redis.call('XADD', vote_audit_key, 'MAXLEN', '~', audit_maxlen, '*',
+                'voter', voter_username,
+                'target', username,
+                'count', vote_counts[i],
+                'ticket', request["ticket"],
+                'timestamp', request["timestamp"],
+                'version', current_version)
+            audit_written = true
+        end
+    end
+
+    -- 将投票事件写入发件箱，由outbox_relay转发到Kafka
+    if outbox_maxlen > 0 and #reported_usernames > 0 then
+        redis.call('XADD', outbox_key, '*',
+            'usernames', cjson.encode(reported_usernames),
+            'votes', cjson.encode(reported_votes),
+            'ticket', request["ticket"],
+            'voter', voter_username,
+            'timestamp', request["timestamp"],
+            'version', current_version)
+    end
+
+    return {success = true, votes = result_votes, totals = reported_votes, version = current_version}
+end
+
+local results = {}
+
+-- 票数恢复完成之前不接受投票，也不消耗票据
+if redis.call('EXISTS', ready_key) == 0 then
+    for i = 1, #requests do
+        results[i] = {success = false, message = "Vote service is warming up, please retry later"}
+    end
+    return cjson.encode(results)
+end
+
+-- 票据键从KEYS[9]开始，与请求列表一一对应
+for i, request in ipairs(requests) do
+    results[i] = apply_vote(KEYS[8 + i], request)
+end
+
+-- 按时间裁剪审计Stream，整批请求只需一次
+if audit_written and audit_retention_ms > 0 then
+    local now = redis.call('TIME')
+    local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    redis.call('XTRIM', vote_audit_key, 'MINID', '~', now_ms - audit_retention_ms)
+end
+
+-- 整批请求合并为一条更新消息，按执行顺序列出，同一用户以最后一次为准
+-- 写入条带的投票不发布；存在条带的用户收到总票数更新时由各进程移出缓存
+if update_channel ~= '' then
+    local updated_usernames = {}
+    local updated_votes = {}
+    for i, result in ipairs(results) do
+        if result["success"] and not result["duplicate"] then
+            local stripe_fields = requests[i]["stripes"] or {}
+            for j, username in ipairs(requests[i]["usernames"]) do
+                if (stripe_fields[j] or '') == '' then
+                    table.insert(updated_usernames, username)
+                    table.insert(updated_votes, result["votes"][j])
+                end
+            end
+        end
+    end
+    if #updated_usernames > 0 then
+        redis.call('PUBLISH', update_channel, cjson.encode({usernames = updated_usernames, votes = updated_votes}))
+    end
+end
+
+-- 返回每个请求更新后的票数和版本
+return cjson.encode(results)
+"""
+
+# 就绪标记缺失时投票脚本返回的消息（与VOTE_SCRIPT中一致）
+WARMING_UP_MESSAGE = "Vote service is warming up, please retry later"
 
 
 class VoteService:
@@ -13,97 +191,149 @@ class VoteService:
         self.redis = RedisConfig.get_redis()
         self.user_votes_key = "user_votes"  # Redis hash key for storing user votes
         self.vote_version_key = "vote_version"  # Redis key for global vote version
+        self.outbox_key = "vote_outbox"  # Redis stream used as the transactional outbox
+        self.audit_key = "vote_audit"  # Redis stream buffering vote audit records for PostgreSQL
+        script_registry.register("vote", VOTE_SCRIPT)
+
+        # 热点用户条带：开启后采样检测热点用户，其增量写入条带，由后台任务合并到总票数
+        self.stripes = VoteStripes(self._fold_stripes)
+
+        # 进程内读缓存，开启后投票脚本发布更新后的票数用于同步缓存（总票数不含条带，条带用户不按消息更新）
+        self.cache = VoteCache(self.stripes.is_striped)
+
+        # 发件箱配置：开启后投票事件由脚本原子写入Redis Stream，请求路径不再访问Kafka
+        self.outbox_enabled = os.getenv("VOTE_OUTBOX_ENABLED", "false").lower() == "true"
+        self.outbox_maxlen = int(os.getenv("VOTE_OUTBOX_MAXLEN", "1000000"))  # 积压上限，达到时拒绝投票
+
+        # 审计Stream的保留策略：近似最大长度，以及按时间保留的毫秒数（0表示只按长度裁剪）
+        self.audit_maxlen = int(os.getenv("VOTE_AUDIT_MAXLEN", "1000000"))
+        self.audit_retention_ms = int(os.getenv("VOTE_AUDIT_RETENTION_MS", "3600000"))
+
+        # 事件格式：json为每个目标用户一条消息，compact为每次投票一条msgpack消息
+        self.compact_events = os.getenv("KAFKA_EVENT_FORMAT", "json").lower() == "compact"
+
+        # 进程内事件队列配置：开启后（且未开启发件箱时）投票事件交给有界队列由后台批量发送
+        self.event_queue = None
+        if os.getenv("VOTE_EVENT_QUEUE_ENABLED", "false").lower() == "true" and not self.outbox_enabled:
+            self.event_queue = VoteEventQueue(self._publish_events)
+
+        # 合并提交配置：开启后，同一时间窗口内的投票请求合并为一次脚本调用
+        self.batch_enabled = os.getenv("VOTE_BATCH_ENABLED", "false").lower() == "true"
+        self.batch_window_ms = float(os.getenv("VOTE_BATCH_WINDOW_MS", "1"))  # 最长等待时间（毫秒）
+        self.batch_max_size = int(os.getenv("VOTE_BATCH_MAX_SIZE", "64"))  # 达到该数量立即提交
+        self._pending = []  # 等待合并提交的 (请求, future) 列表
+        self._flush_timer = None
+        self._flush_tasks = set()  # 持有进行中的批次任务引用，避免被垃圾回收
 
     async def vote_for_users(self, usernames: List[str], voteCount: List[int], ticket: str, voterUsername: str = None):
         """为多个用户投票"""
-        # 验证票据
-        is_valid, message = await ticket_service.validate_ticket(ticket)
-
-        if not is_valid:
+        # 确保voteCount列表长度与usernames列表长度相同（无需访问Redis即可拒绝）
+        if len(voteCount) != len(usernames):
             return {
                 "success": False,
-                "message": message,
+                "message": "Vote count list must have the same length as usernames list",
                 "usernames": [],
                 "votes": []
             }
 
-        # 确保voteCount列表长度与usernames列表长度相同
-        if len(voteCount) != len(usernames):
+        # 在本地校验票据签名和有效期，无效票据不会占用Redis
+        error_message = ticket_service.pre_verify_ticket(ticket)
+        if error_message:
             return {
                 "success": False,
-                "message": "Vote count list must have the same length as usernames list",
+                "message": error_message,
                 "usernames": [],
                 "votes": []
             }
 
-        # 使用Lua脚本实现原子性投票操作
-        vote_script = """
-        local user_votes_key = KEYS[1]
-        local vote_records_key = KEYS[2]
-        local vote_version_key = KEYS[3]
-        local usernames = cjson.decode(ARGV[1])
-        local vote_counts = cjson.decode(ARGV[2])
-        local ticket = ARGV[3]
-        local voter_username = ARGV[4]
-        local timestamp = ARGV[5]
-        
-        -- 增加全局投票版本号
-        local current_version = redis.call('INCR', vote_version_key)
-        
-        -- 存储更新后的投票数
-        local result_votes = {}
-        
-        -- 更新每个用户的票数
-        for i, username in ipairs(usernames) do
-            -- 增加投票数
-            redis.call('HINCRBY', user_votes_key, username, vote_counts[i])
-            
-            -- 获取更新后的票数
-            local updated_votes = redis.call('HGET', user_votes_key, username)
-            table.insert(result_votes, tonumber(updated_votes))
-            
-            -- 如果有投票人信息，记录投票行为
-            if voter_username ~= '' then
-                local vote_record = {
-                    voter = voter_username,
-                    target = username,
-                    count = vote_counts[i],
-                    ticket = ticket,
-                    timestamp = timestamp,
-                    version = current_version
-                }
-                redis.call('LPUSH', vote_records_key, cjson.encode(vote_record))
-            end
-        end
-        
-        -- 返回更新后的票数和当前版本
-        return cjson.encode({votes = result_votes, version = current_version})
-        """
-
         # 准备Lua脚本参数
         timestamp = str(time.time())
+        request = {
+            "usernames": usernames,
+            "votes": voteCount,
+            "ticket": ticket,
+            "voter": voterUsername or "",
+            "timestamp": timestamp
+        }
 
-        # 执行Lua脚本
-        result_json = self.redis.eval(
-            vote_script,
-            3,  # 3个KEYS参数
-            self.user_votes_key,  # KEYS[1]
-            "vote_records",  # KEYS[2]
-            self.vote_version_key,  # KEYS[3]
-            json.dumps(usernames),  # ARGV[1]
-            json.dumps(voteCount),  # ARGV[2]
-            ticket,  # ARGV[3]
-            voterUsername or "",  # ARGV[4]
-            timestamp  # ARGV[5]
-        )
+        # 写入Redis之前先在事件队列中预留位置，队列已满时按策略拒绝请求，避免投票生效但事件无处可放
+        reserved = False
+        if self.event_queue is not None:
+            try:
+                reserved = await self.event_queue.reserve()
+            except EventQueueFullError as e:
+                return {
+                    "success": False,
+                    "message": str(e),
+                    "usernames": [],
+                    "votes": []
+                }
+
+        # 热点用户的增量写入随机选择的条带；只有一个分片时条带与总票数在同一个slot，仍在同一次脚本调用中完成
+        striped = self.stripes.observe(usernames) if self.stripes.enabled else []
+        stripe_shards = {}
+        if striped:
+            fields = [""] * len(usernames)
+            for i in striped:
+                stripe_shards[i], fields[i] = self.stripes.pick(usernames[i])
+            request["stripes"] = fields
+
+        # 票据校验与投票在同一次脚本调用中完成，开启合并提交时与并发请求共用一次调用
+        try:
+            if vote_shards.enabled:
+                result = await self._execute_sharded(request, stripe_shards)
+            elif self.batch_enabled:
+                result = await self._submit_batched(request)
+            else:
+                result = (await self._execute_votes([request]))[0]
+        except Exception:
+            if self.event_queue is not None:
+                self.event_queue.release(reserved)
+            raise
 
-        # 解析结果
-        result = json.loads(result_json)
-        current_votes = result["votes"]
-        current_version = result["version"]
+        if not result["success"]:
+            if self.event_queue is not None:
+                self.event_queue.release(reserved)
+            if result["message"] == WARMING_UP_MESSAGE:
+                # 就绪标记缺失（例如Redis在服务运行中丢失了数据），立即触发恢复
+                rehydration_service.notify_not_ready()
+            return {
+                "success": False,
+                "message": result["message"],
+                "usernames": [],
+                "votes": []
+            }
+        current_votes = result["votes"] or []  # cjson会把空数组编码为{}
+        current_version = result["version"]  # 分片模式下为每个目标用户各自的版本号列表
+        if striped:
+            # 热点用户返回总票数加上未合并条带的票数，写入之后直接从Redis读取（不经过读缓存），包含本次投票
+            for i, count in zip(striped, await self._read_striped_votes([usernames[i] for i in striped])):
+                current_votes[i] = count
 
-        # 发送投票事件到Kafka
-        await self._send_vote_events_to_kafka(usernames, current_votes, ticket, voterUsername, timestamp, current_version)
+        # 条带中的票数合并时才产生投票事件，这里只发送其余用户的事件，票数为写入发件箱的总票数
+        event_usernames, event_votes, event_version = usernames, result["totals"] or [], current_version
+        if striped:
+            reported = [i for i in range(len(usernames)) if i not in striped]
+            event_usernames = [usernames[i] for i in reported]
+            if isinstance(current_version, list):
+                event_version = [current_version[i] for i in reported]
+
+        # 发送投票事件到Kafka（开启发件箱时事件已由脚本写入，交给outbox_relay转发）
+        if self.event_queue is not None:
+            if not event_usernames:
+                self.event_queue.release(reserved)
+            else:
+                await self.event_queue.put({
+                    "usernames": event_usernames,
+                    "vote_counts": event_votes,
+                    "ticket": ticket,
+                    "voter_username": voterUsername,
+                    "timestamp": timestamp,
+                    "version": event_version
+                }, reserved)
+        elif not self.outbox_enabled and event_usernames:
+            await self._send_vote_events_to_kafka(event_usernames, event_votes, ticket, voterUsername, timestamp,
+                                                  event_version)
 
         return {
             "success": True,
@@ -113,6 +343,187 @@ class VoteService:
             "version": current_version
         }
 
+    async def _execute_votes(self, requests: List[dict], shard: int = 0, tickets_consumed: bool = False) -> List[dict]:
+        """通过EVALSHA执行预加载的投票脚本，按顺序处理一批请求并返回各自的结果"""
+        result_json = await script_registry.evalsha(
+            "vote",
+            [
+                vote_shards.key(self.user_votes_key, shard),  # KEYS[1]
+                vote_shards.key(self.audit_key, shard),  # KEYS[2]
+                vote_shards.key(self.vote_version_key, shard),  # KEYS[3]
+                vote_shards.key(self.outbox_key, shard),  # KEYS[4]
+                vote_shards.key(rehydration_service.ready_key, shard),  # KEYS[5]
+                vote_shards.key(rehydration_service.leaderboard_key, shard),  # KEYS[6]
+                vote_shards.key(self.stripes.stripes_key, shard),  # KEYS[7]
+                vote_shards.key(self.stripes.applied_key, shard),  # KEYS[8]
+                # KEYS[9...]: 每个请求对应的票据键（票据已消耗时不传入）
+                *(() if tickets_consumed else
+                  (ticket_service.get_ticket_key(request["ticket"]) for request in requests))
+            ],
+            [
+                ticket_service.max_usage_limit,  # ARGV[1]
+                json.dumps(requests),  # ARGV[2]
+                self.outbox_maxlen if self.outbox_enabled else 0,  # ARGV[3]
+                self.cache.channel if self.cache.enabled else "",  # ARGV[4]
+                self.audit_maxlen,  # ARGV[5]
+                self.audit_retention_ms,  # ARGV[6]
+                1 if tickets_consumed else 0  # ARGV[7]
+            ]
+        )
+        return json.loads(result_json)
+
+    async def _execute_sharded(self, request: dict, stripe_shards: dict = None) -> dict:
+        """票数分片模式：先消耗票据，再在目标用户所在的各分片上并行执行投票脚本
+
+        票据与分片不在同一个slot，无法在一次脚本调用中原子完成：
+        - 消耗票据之前先确认涉及的分片都已就绪，未就绪时直接拒绝，不消耗票据
+        - 部分分片执行失败时，在已成功的分片上以相反的票数撤销（审计中留下对应的负票记录），并退回票据使用次数
+        每个分片有自己的版本号，同一用户总在同一分片，版本号对每个用户仍然单调递增。
+        stripe_shards为 {下标: 条带所在分片}，这些目标用户的票数写入该分片上的条带。
+        """
+        usernames, vote_counts = request["usernames"], request["votes"]
+        stripe_fields = request.get("stripes")
+        groups = {}
+        for i, username in enumerate(usernames):
+            shard = stripe_shards[i] if stripe_shards and i in stripe_shards else vote_shards.shard_of(username)
+            groups.setdefault(shard, []).append(i)
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in groups:
+                pipe.exists(vote_shards.key(rehydration_service.ready_key, shard))
+            if not all(await pipe.execute()):
+                return {"success": False, "message": WARMING_UP_MESSAGE}
+
+        is_valid, message = await ticket_service.validate_ticket(request["ticket"])
+        if not is_valid:
+            return {"success": False, "message": message}
+
+        shard_requests = {}
+        for shard, indices in groups.items():
+            shard_requests[shard] = {
+                **request,
+                "usernames": [usernames[i] for i in indices],
+                "votes": [vote_counts[i] for i in indices]
+            }
+            if stripe_fields:
+                shard_requests[shard]["stripes"] = [stripe_fields[i] for i in indices]
+        shard_results = await asyncio.gather(*(
+            self._execute_votes([shard_request], shard, tickets_consumed=True)
+            for shard, shard_request in shard_requests.items()
+        ), return_exceptions=True)
+
+        failures = [results if isinstance(results, Exception) else results[0]
+                    for results in shard_results
+                    if isinstance(results, Exception) or not results[0]["success"]]
+        if failures:
+            await self._undo_sharded(shard_requests, shard_results)
+            await ticket_service.refund_ticket(request["ticket"])
+            if isinstance(failures[0], Exception):
+                raise failures[0]
+            return failures[0]
+
+        # 按原顺序合并各分片的结果，totals只包含未写入条带的用户
+        votes = [0] * len(usernames)
+        versions = [0] * len(usernames)
+        totals = [None] * len(usernames)
+        for indices, results in zip(groups.values(), shard_results):
+            result = results[0]
+            shard_totals = iter(result["totals"] or [])
+            for i, count in zip(indices, result["votes"] or []):
+                votes[i] = count
+                versions[i] = result["version"]
+                if not (stripe_fields and stripe_fields[i]):
+                    totals[i] = next(shard_totals)
+        return {"success": True, "votes": votes, "version": versions,
+                "totals": [total for total in totals if total is not None]}
+
+    async def _undo_sharded(self, shard_requests: dict, shard_results: list):
+        """在已成功的分片上以相反的票数再执行一次投票脚本，撤销部分成功的分片投票
+
+        撤销同样写入发件箱并递增版本号，Kafka和PostgreSQL最终得到撤销后的总票数；发件箱积压达到上限时也不会被拒绝。
+        """
+        undo = [
+            (shard, {**shard_request, "votes": [-count for count in shard_request["votes"]], "undo": True})
+            for (shard, shard_request), results in zip(shard_requests.items(), shard_results)
+            if not isinstance(results, Exception) and results[0]["success"]
+        ]
+        results = await asyncio.gather(*(
+            self._execute_votes([undo_request], shard, tickets_consumed=True) for shard, undo_request in undo
+        ), return_exceptions=True)
+        for (shard, undo_request), result in zip(undo, results):
+            if isinstance(result, Exception) or not result[0]["success"]:
+                print(f"Error undoing partial vote on shard {shard}: {undo_request} ({result})")
+
+    async def _fold_stripes(self, taken: List[tuple]) -> List[tuple]:
+        """将条带中取出的票数合并到总票数，发送精确的总票数事件，返回已合并（包括此前已合并过）的条目"""
+        timestamp = str(time.time())
+        groups = vote_shards.group([username for username, _, _, _ in taken])
+        shard_results = await asyncio.gather(*(
+            self._execute_votes([{
+                "usernames": [taken[i][0]],
+                "votes": [taken[i][3]],
+                "ticket": "",
+                "voter": "",
+                "timestamp": timestamp,
+                "fold": {"field": taken[i][1], "seq": taken[i][2]}
+            } for i in indices], shard, tickets_consumed=True)
+            for shard, indices in groups.items()
+        ))
+
+        folded = []
+        for indices, results in zip(groups.values(), shard_results):
+            for i, result in zip(indices, results):
+                if not result["success"]:
+                    # 例如票数尚未恢复，取出的票数保留在条带中，下一轮重试
+                    continue
+                folded.append(taken[i])
+                if not result.get("duplicate") and not self.outbox_enabled:
+                    await self._send_vote_events_to_kafka([taken[i][0]], result["totals"], "", None, timestamp,
+                                                          result["version"])
+        return folded
+
+    async def _submit_batched(self, request: dict) -> dict:
+        """将请求加入当前批次，等待批次提交后返回该请求自己的结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((request, future))
+
+        if len(self._pending) >= self.batch_max_size:
+            # 批次已满，立即提交
+            self._flush_pending()
+        elif self._flush_timer is None:
+            # 批次中的第一个请求负责启动计时，窗口结束时提交
+            self._flush_timer = loop.call_later(
+                self.batch_window_ms / 1000, self._flush_pending)
+
+        return await future
+
+    def _flush_pending(self):
+        """提交当前批次"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._execute_batch(batch))
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+
+    async def _execute_batch(self, batch):
+        """执行一个批次，并将结果分发给每个等待中的调用方"""
+        try:
+            results = await self._execute_votes([request for request, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
     async def _send_vote_events_to_kafka(self, usernames: List[str], vote_counts: List[int],
                                          ticket: str, voter_username: str = None, timestamp: str = None, version: int = None):
         """将投票事件发送到Kafka"""
@@ -127,37 +538,117 @@ class VoteService:
             if version is None:
                 raise ValueError("Version is required")
 
-            # 为每个投票创建并发送一个Kafka消息
-            for i, username in enumerate(usernames):
-                # 创建消息数据
-                vote_event = {
-                    "voter": voter_username or "anonymous",
-                    "target": username,
-                    "count": vote_counts[i],
-                    "ticket": ticket,
-                    "timestamp": timestamp,
-                    "version": version
-                }
-
-                # 序列化消息
-                value = json.dumps(vote_event).encode('utf-8')
-
-                # 发送消息到Kafka
-                await producer.send_and_wait(
-                    topic=KafkaConfig.VOTES_TOPIC,
-                    value=value,
-                    # 使用目标用户名作为key，确保相同用户的投票进入相同分区
-                    key=username.encode('utf-8')
-                )
+            # 先全部放入发送缓冲区，再统一等待所有消息的确认，整个请求最多只需等待一次批次发送的延迟
+            futures = await self.enqueue_vote_events(
+                producer, usernames, vote_counts, ticket, voter_username, timestamp, version)
+            await asyncio.gather(*futures)
         except Exception as e:
             # 记录错误但不中断投票流程
             print(f"Error sending vote events to Kafka: {str(e)}")
 
+    async def _publish_events(self, events: List[dict]):
+        """批量发送事件队列中的投票事件，任一消息发送失败时抛出异常"""
+        producer = await KafkaConfig.get_producer()
+        futures = []
+        for event in events:
+            futures.extend(await self.enqueue_vote_events(producer, **event))
+        await asyncio.gather(*futures)
+
+    async def enqueue_vote_events(self, producer, usernames: List[str], vote_counts: List[int],
+                                  ticket: str, voter_username: str, timestamp: str, version):
+        """将投票编码为Kafka消息并放入生产者发送缓冲区，返回等待broker确认的future列表"""
+        messages = encode_vote_events(usernames, vote_counts, ticket, voter_username, timestamp, version,
+                                      compact=self.compact_events)
+        futures = []
+        for key, value in messages:
+            # 加入发送缓冲区，send只等待入队，不等待broker确认
+            futures.append(await producer.send(
+                topic=KafkaConfig.VOTES_TOPIC,
+                value=value,
+                key=key
+            ))
+        return futures
+
     async def get_user_votes(self, username: str):
-        """获取用户的投票数"""
-        votes = self.redis.hget(self.user_votes_key, username)
+        """获取用户的投票数，Redis中的票数尚未恢复时从PostgreSQL读取"""
+        if self.cache.enabled or self.stripes.enabled:
+            return (await self.get_users_votes([username]))[0]
+        # 就绪标记与票数在同一次往返中读取
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(vote_shards.key_for(self.user_votes_key, username), username)
+            pipe.exists(vote_shards.key_for(rehydration_service.ready_key, username))
+            votes, ready = await pipe.execute()
+        if not ready:
+            rehydration_service.notify_not_ready()
+            return await get_vote_count(username)
         return int(votes) if votes else 0
 
+    async def get_users_votes(self, usernames: List[str]) -> List[int]:
+        """批量获取多个用户的投票数，每个分片一次HMGET，在同一次管道往返中完成，结果与usernames顺序一致"""
+        if not usernames:
+            return []
+        cached = self.cache.get_many(usernames) if self.cache.enabled else {}
+        missing = [username for username in usernames if username not in cached]
+        if not missing:
+            return [cached[username] for username in usernames]
+
+        groups = vote_shards.group(missing)
+        striped = self.stripes.striped_among(missing) if self.stripes.enabled else []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard, indices in groups.items():
+                pipe.hmget(vote_shards.key(self.user_votes_key, shard), [missing[i] for i in indices])
+                pipe.exists(vote_shards.key(rehydration_service.ready_key, shard))
+            # 热点用户的条带在同一次往返中读取
+            stripe_reads = [self.stripes.queue_reads(pipe, username) for username in striped]
+            responses = await pipe.execute()
+        responses, stripe_responses = responses[:2 * len(groups)], responses[2 * len(groups):]
+        ready = all(responses[1::2])
+        votes = [None] * len(missing)
+        for indices, counts in zip(groups.values(), responses[0::2]):
+            for i, count in zip(indices, counts):
+                votes[i] = count
+        if not ready:
+            rehydration_service.notify_not_ready()
+            db_votes = await get_votes_by_usernames(usernames)
+            return [db_votes[username][0] if username in db_votes else 0 for username in usernames]
+
+        fetched = {username: int(count) if count else 0 for username, count in zip(missing, votes)}
+        for username, reads in zip(striped, stripe_reads):
+            fetched[username] += self.stripes.unfolded(stripe_responses[:reads])
+            stripe_responses = stripe_responses[reads:]
+        if self.cache.enabled:
+            self.cache.put_many(fetched)
+        return [cached[username] if username in cached else fetched[username] for username in usernames]
+
+    async def _read_striped_votes(self, usernames: List[str]) -> List[int]:
+        """在一次管道往返中读取热点用户的总票数与未合并的条带，不经过读缓存"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            reads = []
+            for username in usernames:
+                pipe.hget(vote_shards.key_for(self.user_votes_key, username), username)
+                reads.append(self.stripes.queue_reads(pipe, username))
+            responses = await pipe.execute()
+        votes = []
+        for reads in reads:
+            total, stripe_responses, responses = responses[0], responses[1:reads + 1], responses[reads + 1:]
+            votes.append(int(total or 0) + self.stripes.unfolded(stripe_responses))
+        return votes
+
+    async def get_vote_events(self, voter: str = None, target: str = None,
+                              since: str = None, until: str = None, limit: int = 100) -> List[dict]:
+        """按投票人或目标用户查询审计记录，时间范围为ISO-8601字符串，默认最近24小时"""
+        if voter is None and target is None:
+            raise ValueError("Either voter or target is required")
+        until_at = self._parse_time(until) if until else datetime.now(timezone.utc)
+        since_at = self._parse_time(since) if since else until_at - timedelta(days=1)
+        return await query_vote_events(voter, target, since_at, until_at, max(min(limit, 1000), 0))
+
+    @staticmethod
+    def _parse_time(value: str) -> datetime:
+        """解析ISO-8601时间，未带时区的按UTC处理"""
+        parsed = datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
 
 # 创建单例实例
 vote_service = VoteService()
@@ -0,0 +1,51 @@
+import os
+import zlib
+from typing import Dict, List
+
+
+class VoteShards:
+    """票数分片配置
+
+    VOTE_SHARDS大于1时，用户按用户名的CRC32分配到固定的分片，每个分片拥有自己的一组键
+    （票数、版本号、排行榜、发件箱、审计Stream、就绪标记），键名带有相同的hash tag，
+    在Redis Cluster中同一分片的键位于同一个slot，投票脚本只访问一个分片，写入可以分散到多个节点。
+    VOTE_SHARDS为1时沿用原有的键名。
+    """
+
+    def __init__(self):
+        self.count = max(int(os.getenv("VOTE_SHARDS", "1")), 1)
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    def shard_of(self, username: str) -> int:
+        """用户所在的分片"""
+        if self.count == 1:
+            return 0
+        return zlib.crc32(username.encode("utf-8")) % self.count
+
+    def key(self, name: str, shard: int = 0) -> str:
+        """分片中的键名，例如 user_votes:{s3}"""
+        if self.count == 1:
+            return name
+        return f"{name}:{{s{shard}}}"
+
+    def keys(self, name: str) -> List[str]:
+        """所有分片中的键名"""
+        return [self.key(name, shard) for shard in range(self.count)]
+
+    def key_for(self, name: str, username: str) -> str:
+        """用户所在分片中的键名"""
+        return self.key(name, self.shard_of(username))
+
+    def group(self, usernames: List[str]) -> Dict[int, List[int]]:
+        """按分片分组，返回 {分片: [usernames中的下标]}"""
+        groups = {}
+        for i, username in enumerate(usernames):
+            groups.setdefault(self.shard_of(username), []).append(i)
+        return groups
+
+
+# 创建单例实例
+vote_shards = VoteShards()
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict, List, Tuple
+
+from ..config.redis import RedisConfig
+from .script_registry import script_registry
+from .vote_shards import vote_shards
+
+# Lua脚本：取出条带中累积的票数准备合并到用户的总票数
+# 取出的票数记为 {field}:out 并分配递增的序号 {field}:seq，合并确认之前不会再取，
+# 重试时返回同一序号，总票数一侧按序号去重，合并中途崩溃不会丢失或重复计数
+TAKE_STRIPES_SCRIPT = """
+local stripes_key = KEYS[1]
+local taken = {}
+for i, field in ipairs(ARGV) do
+    local pending = redis.call('HMGET', stripes_key, field .. ':out', field .. ':seq')
+    if pending[1] then
+        table.insert(taken, {field, tonumber(pending[2]), tonumber(pending[1])})
+    else
+        local amount = tonumber(redis.call('HGET', stripes_key, field) or '0')
+        if amount ~= 0 then
+            local seq = redis.call('HINCRBY', stripes_key, field .. ':seq', 1)
+            redis.call('HSET', stripes_key, field .. ':out', amount)
+            if redis.call('HINCRBY', stripes_key, field, -amount) == 0 then
+                redis.call('HDEL', stripes_key, field)
+            end
+            table.insert(taken, {field, seq, amount})
+        end
+    end
+end
+return cjson.encode(taken)
+"""
+
+# Lua脚本：合并完成后删除已取出的票数，序号不一致说明已被其他实例确认
+ACK_STRIPES_SCRIPT = """
+local stripes_key = KEYS[1]
+for i = 1, #ARGV, 2 do
+    if redis.call('HGET', stripes_key, ARGV[i] .. ':seq') == ARGV[i + 1] then
+        redis.call('HDEL', stripes_key, ARGV[i] .. ':out')
+    end
+end
+return 1
+"""
+
+
+class HotTargetDetector:
+    """采样的热点目标检测器
+
+    按sample_rate对投票请求中的目标用户采样，用固定容量的Misra-Gries计数器估计每个窗口内的高频用户，
+    窗口结束时估计速率（每秒投票请求数）达到阈值的用户成为热点，直到某个窗口低于阈值。
+    """
+
+    def __init__(self):
+        # 从环境变量获取配置，如果没有则使用默认值
+        self.sample_rate = min(max(float(os.getenv("VOTE_HOT_SAMPLE_RATE", "0.05")), 0.0001), 1.0)
+        self.capacity = int(os.getenv("VOTE_HOT_SKETCH_SIZE", "64"))  # 计数器数量
+        self.window = float(os.getenv("VOTE_HOT_WINDOW_MS", "1000")) / 1000
+        self.threshold = float(os.getenv("VOTE_HOT_THRESHOLD", "200"))  # 每秒投票请求数
+        self._counters = {}
+        self._window_start = time.monotonic()
+        self.hot = set()
+
+    def observe(self, usernames: List[str]) -> bool:
+        """记录一次投票请求，窗口结束时更新热点集合，此时存在热点或热点集合发生变化则返回True"""
+        if random.random() < self.sample_rate:
+            for username in usernames:
+                if username in self._counters:
+                    self._counters[username] += 1
+                elif len(self._counters) < self.capacity:
+                    self._counters[username] = 1
+                else:
+                    # 计数器已满，所有计数减一，淘汰降为0的用户
+                    for key in list(self._counters):
+                        self._counters[key] -= 1
+                        if self._counters[key] == 0:
+                            del self._counters[key]
+
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return False
+        # Misra-Gries的计数不会高估，按采样率和窗口长度换算为速率
+        scale = 1 / (self.sample_rate * elapsed)
+        hot = {username for username, count in self._counters.items() if count * scale >= self.threshold}
+        self._counters.clear()
+        self._window_start = now
+        changed, self.hot = hot != self.hot, hot
+        return changed or bool(hot)
+
+
+class VoteStripes:
+    """热点目标的票数条带
+
+    热点用户的增量随机写入K个条带计数器（字段 {username}#{k}，位于分片 (用户所在分片 + k) % 分片数），
+    不更新总票数、排行榜、发件箱和读缓存；后台任务定期将条带中的票数合并到用户的总票数，
+    合并通过投票脚本执行，精确的总票数与版本号照常进入Kafka和PostgreSQL，每次合并只产生一个事件。
+    VOTE_SHARDS大于1时条带分布在min(K, 分片数)个slot上，热点用户的写入分散到多个节点；
+    只有一个分片时所有键都在同一个节点上，节省的只是每次投票的排行榜、发件箱、缓存更新和Kafka事件。
+    投票脚本不读取条带，读取热点用户时在脚本之外把尚未合并的条带加到总票数上。
+    """
+
+    def __init__(self, fold):
+        self.redis = RedisConfig.get_redis()
+        # 从环境变量获取配置，如果没有则使用默认值
+        self.enabled = os.getenv("VOTE_STRIPING_ENABLED", "false").lower() == "true"
+        self.count = max(int(os.getenv("VOTE_STRIPES", "8")), 1)  # 每个热点用户的条带数K
+        self.fold_interval = float(os.getenv("VOTE_STRIPE_FOLD_MS", "200")) / 1000
+        self.cooldown_ms = int(os.getenv("VOTE_HOT_COOLDOWN_MS", "30000"))  # 不再热点多久后移出条带集合
+        self.stripes_key = "vote_stripes"
+        self.applied_key = "vote_stripe_applied"  # 每个条带已合并的序号，与总票数在同一分片
+        self.hot_key = "vote_hot_targets"  # 所有实例共享的条带用户集合，分数为最近一次被判定为热点的时间
+        self.lock_key = "vote_stripe_fold_lock"
+        self.detector = HotTargetDetector()
+        script_registry.register("take_stripes", TAKE_STRIPES_SCRIPT)
+        script_registry.register("ack_stripes", ACK_STRIPES_SCRIPT)
+
+        self._fold = fold  # 执行合并的回调，参数为 [(username, field, seq, amount)]，返回已合并的条目
+        self._striped = set()  # 共享集合的本地副本，读取时据此判断是否需要加上条带
+        self._folder = None
+        self._tasks = set()  # 持有后台写入任务的引用，避免被垃圾回收
+        self._stats = {
+            "striped_votes": 0,
+            "folds": 0,
+            "folded_votes": 0
+        }
+
+    def observe(self, usernames: List[str]) -> List[int]:
+        """记录一次投票请求，返回其中需要条带写入的目标用户下标"""
+        self._ensure_folder()
+        if self.detector.observe(usernames) and self.detector.hot:
+            self._publish_hot(self.detector.hot)
+        if not self.detector.hot:
+            return []
+        return [i for i, username in enumerate(usernames) if username in self.detector.hot]
+
+    def pick(self, username: str) -> Tuple[int, str]:
+        """随机选择一个条带，返回 (分片, 字段)"""
+        stripe = random.randrange(self.count)
+        self._stats["striped_votes"] += 1
+        return self._stripe_shard(username, stripe), f"{username}#{stripe}"
+
+    def _stripe_shard(self, username: str, stripe: int) -> int:
+        return (vote_shards.shard_of(username) + stripe) % vote_shards.count
+
+    def _fields_by_shard(self, username: str) -> Dict[int, List[str]]:
+        by_shard = {}
+        for stripe in range(self.count):
+            by_shard.setdefault(self._stripe_shard(username, stripe), []).append(f"{username}#{stripe}")
+        return by_shard
+
+    def is_striped(self, username: str) -> bool:
+        """用户是否可能存在未合并的条带"""
+        return username in self._striped or username in self.detector.hot
+
+    def striped_among(self, usernames: List[str]) -> List[str]:
+        """可能存在未合并条带的用户"""
+        self._ensure_folder()
+        return [username for username in usernames if self.is_striped(username)]
+
+    def queue_reads(self, pipe, username: str) -> int:
+        """在管道中加入读取一个用户所有条带的命令（每个条带分片一次HMGET），返回加入的命令数，结果交给unfolded()"""
+        by_shard = self._fields_by_shard(username)
+        for shard, fields in by_shard.items():
+            pipe.hmget(vote_shards.key(self.stripes_key, shard),
+                       [name for field in fields for name in (field, f"{field}:out", f"{field}:seq")])
+        pipe.hmget(vote_shards.key_for(self.applied_key, username),
+                   [field for fields in by_shard.values() for field in fields])
+        return len(by_shard) + 1
+
+    def unfolded(self, responses: list) -> int:
+        """由queue_reads()的结果计算尚未计入总票数的条带票数"""
+        stripes = [value for response in responses[:-1] for value in response]
+        total = 0
+        for (amount, out, seq), applied in zip(zip(*[iter(stripes)] * 3), responses[-1]):
+            total += int(amount or 0)
+            # 已取出但总票数一侧尚未按该序号合并
+            if out is not None and int(applied or 0) < int(seq):
+                total += int(out)
+        return total
+
+    def _publish_hot(self, usernames):
+        """将本实例判定的热点加入共享集合（在后台执行，不阻塞投票）"""
+        now_ms = int(time.time() * 1000)
+        self._striped.update(usernames)
+        task = asyncio.create_task(self._zadd_hot({username: now_ms for username in usernames}))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _zadd_hot(self, mapping: Dict[str, int]):
+        try:
+            await self.redis.zadd(self.hot_key, mapping)
+        except Exception as e:
+            print(f"Error publishing hot vote targets: {e}")
+
+    def _ensure_folder(self):
+        """按需启动后台合并任务"""
+        if self._folder is None or self._folder.done():
+            self._folder = asyncio.create_task(self._run_folder())
+
+    async def _run_folder(self):
+        """刷新共享集合的本地副本，并在取得锁时合并所有条带用户的条带"""
+        while True:
+            try:
+                members = dict(await self.redis.zrange(self.hot_key, 0, -1, withscores=True))
+                self._striped = set(members) | self.detector.hot
+                # 每轮只有一个实例执行合并
+                if members and await self.redis.set(self.lock_key, "1", nx=True,
+                                                    px=max(int(self.fold_interval * 1000), 1)):
+                    await self.fold_once(members)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error folding vote stripes: {e}")
+            await asyncio.sleep(self.fold_interval)
+
+    async def fold_once(self, members: Dict[str, float]):
+        """取出条带中的票数，合并到总票数后确认，并移除已冷却且条带为空的用户"""
+        usernames = list(members)
+        by_shard = {}
+        for username in usernames:
+            for shard, fields in self._fields_by_shard(username).items():
+                by_shard.setdefault(shard, []).extend(fields)
+        shard_taken = await asyncio.gather(*(
+            script_registry.evalsha("take_stripes", [vote_shards.key(self.stripes_key, shard)], fields)
+            for shard, fields in by_shard.items()
+        ))
+        taken = [(field.rpartition("#")[0], field, seq, amount)
+                 for result in shard_taken for field, seq, amount in json.loads(result) or []]
+
+        if taken:
+            folded = await self._fold(taken)
+            acks = {}
+            for username, field, seq, _ in folded:
+                stripe = int(field.rpartition("#")[2])
+                acks.setdefault(self._stripe_shard(username, stripe), []).extend([field, seq])
+            await asyncio.gather(*(
+                script_registry.evalsha("ack_stripes", [vote_shards.key(self.stripes_key, shard)], args)
+                for shard, args in acks.items()
+            ))
+            self._stats["folds"] += len(folded)
+            self._stats["folded_votes"] += sum(amount for _, _, _, amount in folded)
+
+        # 冷却的用户在本轮没有取出任何票数时移出集合；移出后若又被判定为热点，下一个窗口会重新加入
+        busy = {username for username, _, _, _ in taken}
+        expire_before = time.time() * 1000 - self.cooldown_ms
+        cold = [username for username, score in members.items()
+                if score < expire_before and username not in busy]
+        if cold:
+            await self.redis.zrem(self.hot_key, *cold)
+
+    async def close(self):
+        """停止后台合并任务"""
+        if self._folder is not None:
+            self._folder.cancel()
+            try:
+                await self._folder
+            except asyncio.CancelledError:
+                pass
+            self._folder = None
+
+    def get_stats(self) -> dict:
+        """获取热点用户和条带合并统计"""
+        return {
+            "enabled": self.enabled,
+            "stripes": self.count,
+            "hot": sorted(self.detector.hot),
+            "striped_targets": len(self._striped),
+            **self._stats
+        }
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+投票审计写入服务入口点
+
+投票脚本将带有投票人的投票记录写入有界的Redis Stream（vote_audit），
+本服务通过消费者组批量读取，用COPY写入按天分区的PostgreSQL vote_events表，
+写入成功后再XACK/XDEL。重复写入会被主键忽略，崩溃后重试是幂等的。
+"""
+
+import asyncio
+import os
+import signal
+from datetime import datetime, timezone
+
+from redis.exceptions import ResponseError
+
+from ..config.redis import RedisConfig
+from ..database.db import init_db, copy_vote_events
+from ..services.vote_service import vote_service
+from ..services.vote_shards import vote_shards
+
+
+class AuditWriter:
+    """投票审计写入器"""
+
+    def __init__(self):
+        self.redis = RedisConfig.get_redis()
+        self.audit_key = vote_service.audit_key
+        self.stream_keys = vote_shards.keys(self.audit_key)  # 票数分片时每个分片有自己的Stream
+        # 不同分片的Stream ID可能相同，事件ID加上分片前缀
+        self.event_id_prefixes = {
+            key: f"s{shard}-" if vote_shards.enabled else "" for shard, key in enumerate(self.stream_keys)}
+        self.group_name = os.getenv("AUDIT_WRITER_GROUP", "audit_writer")
+        # 消费者名称使用Pod主机名，重启后可以继续处理自己未确认的消息
+        self.consumer_name = os.getenv("HOSTNAME", "audit-writer")
+        self.batch_size = int(os.getenv("AUDIT_WRITER_BATCH_SIZE", "5000"))
+        self.block_ms = int(os.getenv("AUDIT_WRITER_BLOCK_MS", "1000"))
+        self.idle_sleep = float(os.getenv("AUDIT_WRITER_IDLE_MS", "50")) / 1000  # 多个Stream都为空时的等待时间
+        # 其他写入器实例崩溃后，其未确认的消息闲置超过该时间后被接管
+        self.claim_idle_ms = int(os.getenv("AUDIT_WRITER_CLAIM_IDLE_MS", "30000"))
+        self.running = False
+
+    async def start(self):
+        """启动写入器"""
+        self.running = True
+
+        # 设置信号处理器用于优雅关闭
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        await init_db()
+        await self.ensure_group()
+        print(f"Started writing {self.audit_key} to vote_events...")
+
+        try:
+            while self.running:
+                try:
+                    idle = True
+                    for stream_key in self.stream_keys:
+                        entries = await self.read_batch(stream_key)
+                        if entries:
+                            idle = False
+                            await self.write_batch(stream_key, entries)
+                    if idle and len(self.stream_keys) > 1:
+                        # 多个Stream时不阻塞读取，空闲时短暂等待
+                        await asyncio.sleep(self.idle_sleep)
+                except Exception as e:
+                    # 未确认的消息保留在待处理列表中，稍后重试
+                    print(f"Error writing vote audit entries: {e}")
+                    await asyncio.sleep(1)
+        finally:
+            await RedisConfig.close_redis()
+
+    async def ensure_group(self):
+        """创建消费者组（已存在时忽略）"""
+        for stream_key in self.stream_keys:
+            try:
+                await self.redis.xgroup_create(
+                    stream_key, self.group_name, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def read_batch(self, stream_key):
+        """读取一批待写入的记录：优先处理自己未确认的，其次接管闲置的，最后读取新记录"""
+        response = await self.redis.xreadgroup(
+            self.group_name, self.consumer_name, {stream_key: "0"},
+            count=self.batch_size)
+        entries = response[0][1] if response else []
+        if entries:
+            return entries
+
+        claimed = await self.redis.xautoclaim(
+            stream_key, self.group_name, self.consumer_name,
+            min_idle_time=self.claim_idle_ms, count=self.batch_size)
+        if claimed[1]:
+            return claimed[1]
+
+        response = await self.redis.xreadgroup(
+            self.group_name, self.consumer_name, {stream_key: ">"},
+            count=self.batch_size, block=self.block_ms if len(self.stream_keys) == 1 else None)
+        return response[0][1] if response else []
+
+    async def write_batch(self, stream_key, entries):
+        """将一批审计记录写入数据库，成功后再从Stream中删除"""
+        prefix = self.event_id_prefixes[stream_key]
+        events = [
+            (
+                prefix + entry_id,
+                fields["voter"],
+                fields["target"],
+                int(fields["count"]),
+                fields["ticket"],
+                int(fields["version"]),
+                datetime.fromtimestamp(float(fields["timestamp"]), tz=timezone.utc)
+            )
+            # 被裁剪掉内容的消息只剩ID，跳过
+            for entry_id, fields in entries if fields
+        ]
+        if events:
+            await copy_vote_events(events)
+
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe = self.redis.pipeline()
+        pipe.xack(stream_key, self.group_name, *entry_ids)
+        pipe.xdel(stream_key, *entry_ids)
+        await pipe.execute()
+        print(f"Wrote {len(events)} vote audit records")
+
+    def stop(self):
+        """停止写入循环，当前批次处理完成后退出"""
+        print("Shutting down audit writer...")
+        self.running = False
+
+
+async def main():
+    """主函数"""
+    writer = AuditWriter()
+    await writer.start()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+死信队列重放工具
+
+读取votes.dlq中的消息，按x-original-topic头重新发送到原始topic（默认votes），
+重试计数清零，原始分区和偏移量保留在消息头中。
+通过独立的消费者组记录重放进度，重复执行只会重放新进入死信队列的消息。
+
+用法:
+    python -m app.workers.dlq_replay [--limit N] [--dry-run]
+"""
+
+import argparse
+import asyncio
+import os
+
+from aiokafka import AIOKafkaConsumer
+
+from ..config.kafka import KafkaConfig
+
+
+async def replay(limit=None, dry_run=False, group_id="vote_dlq_replay"):
+    """重放死信队列中的消息，返回重放的消息数"""
+    consumer = AIOKafkaConsumer(
+        KafkaConfig.VOTES_DLQ_TOPIC,
+        bootstrap_servers=os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092"),
+        group_id=group_id,
+        auto_offset_reset="earliest",
+        enable_auto_commit=False
+    )
+    await consumer.start()
+    producer = None if dry_run else await KafkaConfig.get_producer()
+    replayed = 0
+
+    try:
+        while limit is None or replayed < limit:
+            max_records = 500 if limit is None else min(500, limit - replayed)
+            records = await consumer.getmany(timeout_ms=2000, max_records=max_records)
+            messages = [msg for partition_messages in records.values()
+                        for msg in partition_messages]
+            if not messages:
+                # 已追上死信队列末尾
+                break
+
+            futures = []
+            for msg in messages:
+                headers = dict(msg.headers or ())
+                topic = headers.get("x-original-topic", KafkaConfig.VOTES_TOPIC.encode()).decode('utf-8')
+                # 重放的消息重新开始重试计数，保留原始位置便于追踪
+                replay_headers = [(key, value) for key, value in msg.headers or ()
+                                  if key not in ("x-retry-count", "x-retry-at")]
+                print(f"Replaying DLQ offset {msg.offset} to {topic} "
+                      f"(original partition={headers.get('x-original-partition', b'?').decode()}, "
+                      f"offset={headers.get('x-original-offset', b'?').decode()}, "
+                      f"error={headers.get('x-error', b'').decode()})")
+                if not dry_run:
+                    futures.append(await producer.send(
+                        topic, value=msg.value, key=msg.key, headers=replay_headers))
+
+            if not dry_run:
+                await asyncio.gather(*futures)
+                await consumer.commit()
+            replayed += len(messages)
+    finally:
+        await consumer.stop()
+        await KafkaConfig.close_producer()
+
+    print(f"Replayed {replayed} messages{' (dry run)' if dry_run else ''}")
+    return replayed
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="Replay messages from the votes dead letter queue")
+    parser.add_argument("--limit", type=int, default=None, help="最多重放的消息数")
+    parser.add_argument("--dry-run", action="store_true", help="只打印消息，不发送也不提交偏移量")
+    parser.add_argument("--group", default="vote_dlq_replay", help="记录重放进度的消费者组")
+    args = parser.parse_args()
+    asyncio.run(replay(limit=args.limit, dry_run=args.dry_run, group_id=args.group))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+发件箱转发服务入口点
+
+投票脚本将投票事件与计数更新原子写入Redis Stream发件箱，
+本服务通过消费者组批量读取发件箱，转发到Kafka的votes主题，
+确认发送成功后再XACK/XDEL，保证事件不会被静默丢弃。
+发件箱不按长度裁剪：积压（尚未确认删除的消息数）达到VOTE_OUTBOX_MAXLEN时，投票脚本拒绝新的投票，
+转发器在积压接近上限时输出警告。被外部删除（例如手动XTRIM/XDEL）的消息逐条记录日志，
+并计入统计（/metrics/outbox的trimmed），其中的投票事件需要由对账服务修复。
+"""
+
+import asyncio
+import json
+import os
+import signal
+
+from redis.exceptions import ResponseError
+
+from ..config.kafka import KafkaConfig
+from ..config.redis import RedisConfig
+from ..services.vote_service import vote_service
+from ..services.vote_shards import vote_shards
+
+
+class OutboxRelay:
+    """发件箱转发器"""
+
+    def __init__(self):
+        self.redis = RedisConfig.get_redis()
+        self.outbox_key = vote_service.outbox_key
+        self.stream_keys = vote_shards.keys(self.outbox_key)  # 票数分片时每个分片有自己的Stream
+        self.group_name = os.getenv("OUTBOX_RELAY_GROUP", "outbox_relay")
+        # 消费者名称使用Pod主机名，重启后可以继续处理自己未确认的消息
+        self.consumer_name = os.getenv("HOSTNAME", "outbox-relay")
+        self.batch_size = int(os.getenv("OUTBOX_RELAY_BATCH_SIZE", "1000"))
+        self.block_ms = int(os.getenv("OUTBOX_RELAY_BLOCK_MS", "1000"))
+        self.idle_sleep = float(os.getenv("OUTBOX_RELAY_IDLE_MS", "50")) / 1000  # 多个Stream都为空时的等待时间
+        # 其他转发器实例崩溃后，其未确认的消息闲置超过该时间后被接管
+        self.claim_idle_ms = int(os.getenv("OUTBOX_RELAY_CLAIM_IDLE_MS", "30000"))
+        # 积压达到发件箱积压上限的该比例时输出警告
+        self.backlog_warn_ratio = float(os.getenv("OUTBOX_RELAY_BACKLOG_WARN_RATIO", "0.8"))
+        self.stats_key = "vote_outbox_stats"  # 转发统计，由主服务的/metrics/outbox读取
+        self.running = False
+
+    async def start(self):
+        """启动转发器"""
+        self.running = True
+
+        # 设置信号处理器用于优雅关闭
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        await self.ensure_group()
+        producer = await KafkaConfig.get_producer()
+        print(f"Started relaying from {self.outbox_key} to {KafkaConfig.VOTES_TOPIC}...")
+
+        try:
+            while self.running:
+                try:
+                    idle = True
+                    for stream_key in self.stream_keys:
+                        entries = await self.read_batch(stream_key)
+                        if entries:
+                            idle = False
+                            await self.relay_batch(producer, stream_key, entries)
+                    if idle and len(self.stream_keys) > 1:
+                        # 多个Stream时不阻塞读取，空闲时短暂等待
+                        await asyncio.sleep(self.idle_sleep)
+                except Exception as e:
+                    # 未确认的消息保留在待处理列表中，稍后重试
+                    print(f"Error relaying outbox entries: {e}")
+                    await asyncio.sleep(1)
+        finally:
+            await self.shutdown()
+
+    async def ensure_group(self):
+        """创建消费者组（已存在时忽略）"""
+        for stream_key in self.stream_keys:
+            try:
+                await self.redis.xgroup_create(
+                    stream_key, self.group_name, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def read_batch(self, stream_key):
+        """读取一批待转发的消息：优先处理自己未确认的，其次接管闲置的，最后读取新消息"""
+        # 1. 自己之前读取但未确认的消息（例如上次发送Kafka失败）
+        response = await self.redis.xreadgroup(
+            self.group_name, self.consumer_name, {stream_key: "0"},
+            count=self.batch_size)
+        entries = response[0][1] if response else []
+        if entries:
+            return entries
+
+        # 2. 接管其他已崩溃实例闲置的消息
+        claimed = await self.redis.xautoclaim(
+            stream_key, self.group_name, self.consumer_name,
+            min_idle_time=self.claim_idle_ms, count=self.batch_size)
+        # 已被删除的待处理消息由XAUTOCLAIM移出待处理列表，只返回ID，同样计入被删除的消息
+        deleted = claimed[2] if len(claimed) > 2 else []
+        if deleted:
+            for entry_id in deleted:
+                self.log_trimmed(stream_key, entry_id)
+            await self.redis.hincrby(self.stats_key, "trimmed", len(deleted))
+        if claimed[1]:
+            return claimed[1]
+
+        # 3. 阻塞读取新消息
+        response = await self.redis.xreadgroup(
+            self.group_name, self.consumer_name, {stream_key: ">"},
+            count=self.batch_size, block=self.block_ms if len(self.stream_keys) == 1 else None)
+        return response[0][1] if response else []
+
+    async def relay_batch(self, producer, stream_key, entries):
+        """将一批发件箱消息发送到Kafka，全部确认后再从发件箱中删除"""
+        futures = []
+        trimmed = 0
+        for entry_id, fields in entries:
+            # 被外部删除内容的消息只剩ID，其中的投票事件已丢失，只能记录后跳过
+            if not fields:
+                trimmed += 1
+                self.log_trimmed(stream_key, entry_id)
+                continue
+            futures.extend(await vote_service.enqueue_vote_events(
+                producer,
+                json.loads(fields["usernames"]) or [],
+                json.loads(fields["votes"]) or [],
+                fields["ticket"],
+                fields["voter"],
+                fields["timestamp"],
+                int(fields["version"])
+            ))
+        await asyncio.gather(*futures)
+
+        # 所有消息已被Kafka确认，确认并删除发件箱中的消息
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe = self.redis.pipeline()
+        pipe.xack(stream_key, self.group_name, *entry_ids)
+        pipe.xdel(stream_key, *entry_ids)
+        pipe.hincrby(self.stats_key, "relayed", len(entry_ids) - trimmed)
+        pipe.hincrby(self.stats_key, "trimmed", trimmed)
+        pipe.xlen(stream_key)
+        backlog = (await pipe.execute())[-1]
+        await self.redis.hset(self.stats_key, f"backlog:{stream_key}", backlog)
+        print(f"Relayed {len(entry_ids)} outbox entries ({len(futures)} messages)")
+
+        maxlen = vote_service.outbox_maxlen
+        if maxlen > 0 and backlog >= maxlen * self.backlog_warn_ratio:
+            print(f"Warning: outbox {stream_key} backlog {backlog} is close to VOTE_OUTBOX_MAXLEN {maxlen}, "
+                  f"votes will be rejected once it is reached")
+
+    @staticmethod
+    def log_trimmed(stream_key, entry_id):
+        print(f"Outbox entry {entry_id} in {stream_key} was deleted before relay, its vote events are lost")
+
+    def stop(self):
+        """停止转发循环，当前批次处理完成后退出"""
+        print("Shutting down outbox relay...")
+        self.running = False
+
+    async def shutdown(self):
+        """关闭Kafka生产者和Redis连接"""
+        await KafkaConfig.close_producer()
+        await RedisConfig.close_redis()
+
+
+async def main():
+    """主函数"""
+    relay = OutboxRelay()
+    await relay.start()
+
+if __name__ == "__main__":
+    asyncio.run(main())
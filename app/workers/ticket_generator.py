@@ -52,6 +52,7 @@ async def lifespan(app: FastAPI):
         print("Forcing ticket generator shutdown...")
         generator_task.cancel()
 
+    await RedisConfig.close_redis()
     print("Ticket generation service has stopped")
 
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+从Kafka votes主题重建PostgreSQL票数
+
+并行读取votes主题的所有分区，在内存中只保留每个用户版本号最高的票数，
+定期通过COPY批量导入votes表（按版本号合并）并记录检查点偏移量，中断后可以从检查点继续。
+
+用法:
+    python -m app.workers.vote_backfill                       # 从最早的消息开始
+    python -m app.workers.vote_backfill --from-timestamp 2025-01-01T00:00:00
+    python -m app.workers.vote_backfill --from-offsets 0:1000,1:2000
+    python -m app.workers.vote_backfill --resume              # 从检查点继续
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+from aiokafka import AIOKafkaConsumer, TopicPartition
+
+from ..config.kafka import KafkaConfig
+from ..database.db import init_db, copy_merge_votes
+from ..models.vote_event import decode_vote_events
+
+
+class VoteBackfill:
+    """投票数据回填器"""
+
+    def __init__(self, checkpoint_path, checkpoint_interval=30.0, batch_size=5000):
+        self.bootstrap_servers = os.getenv(
+            "KAFKA_BOOTSTRAP_SERVERS", "localhost:9092")
+        self.topic = KafkaConfig.VOTES_TOPIC
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval  # 检查点间隔（秒）
+        self.batch_size = batch_size
+        self.consumer = None
+        self.latest_votes = {}  # {username: (count, version)}
+        self.positions = {}  # {partition: 下一条待读取的偏移量}
+        self.processed = 0
+        self.skipped = 0
+
+    async def run(self, from_timestamp=None, from_offsets=None, resume=False):
+        """执行回填"""
+        await init_db()
+
+        # 不加入消费者组，直接分配所有分区
+        self.consumer = AIOKafkaConsumer(
+            bootstrap_servers=self.bootstrap_servers,
+            enable_auto_commit=False,
+            auto_offset_reset="earliest",
+            max_partition_fetch_bytes=8 * 1024 * 1024
+        )
+        await self.consumer.start()
+        try:
+            # 加载集群元数据后才能获取分区列表
+            await self.consumer.topics()
+            partitions = [TopicPartition(self.topic, p)
+                          for p in sorted(self.consumer.partitions_for_topic(self.topic) or [])]
+            if not partitions:
+                print(f"Topic {self.topic} has no partitions")
+                return
+            self.consumer.assign(partitions)
+
+            await self.seek_start(partitions, from_timestamp, from_offsets, resume)
+
+            # 以开始时的末尾偏移量作为终点，回填期间新写入的消息由常规消费者处理
+            end_offsets = await self.consumer.end_offsets(partitions)
+            remaining = {}
+            for tp in partitions:
+                self.positions[tp.partition] = await self.consumer.position(tp)
+                if self.positions[tp.partition] < end_offsets[tp]:
+                    remaining[tp] = end_offsets[tp]
+            total = sum(end - self.positions[tp.partition] for tp, end in remaining.items())
+            print(f"Backfilling {total} messages from {len(partitions)} partitions...")
+
+            await self.consume_until(remaining, total)
+            await self.checkpoint()
+            print(f"Backfill finished: {self.processed} messages processed, {self.skipped} skipped")
+        finally:
+            await self.consumer.stop()
+
+    async def seek_start(self, partitions, from_timestamp, from_offsets, resume):
+        """确定每个分区的起始偏移量"""
+        if resume:
+            offsets = self.load_checkpoint()
+            for tp in partitions:
+                if str(tp.partition) in offsets:
+                    self.consumer.seek(tp, offsets[str(tp.partition)])
+                else:
+                    await self.consumer.seek_to_beginning(tp)
+            print(f"Resuming from checkpoint {self.checkpoint_path}: {offsets}")
+        elif from_offsets:
+            for tp in partitions:
+                if tp.partition in from_offsets:
+                    self.consumer.seek(tp, from_offsets[tp.partition])
+                else:
+                    await self.consumer.seek_to_beginning(tp)
+        elif from_timestamp is not None:
+            found = await self.consumer.offsets_for_times(
+                {tp: from_timestamp for tp in partitions})
+            for tp in partitions:
+                if found.get(tp) is not None:
+                    self.consumer.seek(tp, found[tp].offset)
+                else:
+                    # 该分区没有晚于指定时间的消息
+                    await self.consumer.seek_to_end(tp)
+        else:
+            await self.consumer.seek_to_beginning(*partitions)
+
+    async def consume_until(self, remaining, total):
+        """读取到每个分区的末尾偏移量为止，定期输出进度并写入检查点"""
+        start_time = time.monotonic()
+        last_checkpoint = last_report = start_time
+
+        while remaining:
+            records = await self.consumer.getmany(
+                *remaining.keys(), timeout_ms=1000, max_records=self.batch_size)
+            for tp, messages in records.items():
+                for msg in messages:
+                    if msg.offset >= remaining.get(tp, 0):
+                        break
+                    self.fold_message(msg)
+                    self.positions[tp.partition] = msg.offset + 1
+
+            # 读取位置越过末尾偏移量的分区已完成（末尾可能是事务控制记录，不会返回给消费者）
+            for tp in list(remaining):
+                if await self.consumer.position(tp) >= remaining[tp]:
+                    self.positions[tp.partition] = max(self.positions[tp.partition], remaining.pop(tp))
+
+            now = time.monotonic()
+            if now - last_report >= 5:
+                elapsed = now - start_time
+                print(f"Progress: {self.processed}/{total} messages "
+                      f"({self.processed / elapsed:.0f} msg/s), {len(self.latest_votes)} users pending")
+                last_report = now
+            if now - last_checkpoint >= self.checkpoint_interval:
+                await self.checkpoint()
+                last_checkpoint = now
+
+    def fold_message(self, msg):
+        """将消息折叠进内存，每个用户只保留版本号最高的票数"""
+        try:
+            events = decode_vote_events(msg.value)
+        except Exception as e:
+            print(f"Skipping undecodable message (partition={msg.partition}, offset={msg.offset}): {e}")
+            self.skipped += 1
+            return
+
+        for vote_data in events:
+            username = vote_data.get('target')
+            if not username:
+                continue
+            count = vote_data.get('count', 1)
+            version = vote_data.get('version', 1)
+            current = self.latest_votes.get(username)
+            if current is None or version > current[1]:
+                self.latest_votes[username] = (count, version)
+        self.processed += 1
+
+    async def checkpoint(self):
+        """将内存中的票数导入数据库，成功后再记录偏移量，保证检查点之前的消息都已落库"""
+        if self.latest_votes:
+            await copy_merge_votes(self.latest_votes)
+            print(f"Loaded {len(self.latest_votes)} users into votes")
+            self.latest_votes = {}
+
+        checkpoint = {
+            "topic": self.topic,
+            "offsets": {str(partition): offset for partition, offset in self.positions.items()},
+            "updated_at": datetime.now().isoformat()
+        }
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def load_checkpoint(self):
+        """读取检查点中的偏移量"""
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            return json.load(f)["offsets"]
+
+
+def parse_offsets(value):
+    """解析 partition:offset 列表，例如 0:1000,1:2000"""
+    offsets = {}
+    for item in value.split(","):
+        partition, offset = item.split(":")
+        offsets[int(partition)] = int(offset)
+    return offsets
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="Rebuild the votes table from the Kafka votes topic")
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument("--from-timestamp", help="从该时间（ISO-8601）之后的消息开始")
+    start.add_argument("--from-offsets", type=parse_offsets, help="从指定偏移量开始，格式 partition:offset,...")
+    start.add_argument("--resume", action="store_true", help="从检查点继续")
+    parser.add_argument("--checkpoint-file", default=os.getenv(
+        "VOTE_BACKFILL_CHECKPOINT", "/tmp/vote_backfill.checkpoint.json"), help="检查点文件路径")
+    parser.add_argument("--checkpoint-interval", type=float, default=30.0, help="检查点间隔（秒）")
+    parser.add_argument("--batch-size", type=int, default=5000, help="每次拉取的最大消息数")
+    args = parser.parse_args()
+
+    from_timestamp = None
+    if args.from_timestamp:
+        from_timestamp = int(datetime.fromisoformat(args.from_timestamp).timestamp() * 1000)
+
+    backfill = VoteBackfill(args.checkpoint_file, args.checkpoint_interval, args.batch_size)
+    asyncio.run(backfill.run(from_timestamp=from_timestamp,
+                             from_offsets=args.from_offsets, resume=args.resume))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,16 @@
 
 from app.config.kafka import KafkaConfig
 import asyncio
-import json
 import os
 import signal
 import sys
-from aiokafka import AIOKafkaConsumer
+import time
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
 from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
 from ..models.vote import Vote
-from ..database.db import async_session
+from ..models.vote_event import decode_vote_events
+from ..database.db import async_session, upsert_votes
 import datetime
 
 # 添加项目根目录到Python路径
@@ -18,6 +20,73 @@ sys.path.append(os.path.abspath(
     os.path.join(os.path.dirname(__file__), '../..')))
 
 
+class PartitionWorker:
+    """单个分区的有序处理管道，独立处理批次并提交该分区的偏移量"""
+
+    def __init__(self, owner, tp, max_queued_batches):
+        self.owner = owner
+        self.tp = tp
+        self.max_queued_batches = max_queued_batches
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    def submit(self, messages):
+        """提交一批消息，积压过多时暂停拉取该分区，不影响其他分区"""
+        self.queue.put_nowait(messages)
+        if self.queue.qsize() >= self.max_queued_batches:
+            self.owner.consumer.pause(self.tp)
+
+    async def run(self):
+        """按顺序处理该分区的批次，每个批次使用独立的数据库会话"""
+        while True:
+            messages = await self.queue.get()
+            try:
+                if self.owner.batch_enabled:
+                    await self.owner.retry_until_success(
+                        lambda: self.owner.process_batch_messages(messages))
+                else:
+                    # 未开启批量模式时逐条处理，与非分区模式的逐条消费一致
+                    for msg in messages:
+                        await self.owner.retry_until_success(
+                            lambda msg=msg: self.owner.process_or_route(msg))
+                await self.owner.consumer.commit({self.tp: messages[-1].offset + 1})
+            except Exception as e:
+                # 偏移量提交失败时由下一批次的提交覆盖
+                print(f"Failed to commit offset for {self.tp}: {e}")
+            finally:
+                self.queue.task_done()
+                if self.queue.empty() and self.tp in self.owner.consumer.paused():
+                    self.owner.consumer.resume(self.tp)
+
+    async def drain(self, timeout):
+        """处理完已提交的批次后停止；超时（例如PostgreSQL或Kafka不可用）时放弃剩余批次且不提交偏移量，
+        这些消息由分区的新所有者重新消费（处理均为幂等）"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out draining {self.tp} after {timeout}s, "
+                  f"{self.queue.qsize()} queued batches left uncommitted")
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class VoteRebalanceListener(ConsumerRebalanceListener):
+    """分区再均衡监听器：分区被收回前处理完积压的批次并提交偏移量"""
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    async def on_partitions_revoked(self, revoked):
+        await self.owner.stop_partition_workers(revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        for tp in assigned:
+            self.owner.get_partition_worker(tp)
+
+
 class VoteConsumer:
     """投票消息消费者"""
 
@@ -30,6 +99,24 @@ class VoteConsumer:
         self.consumer = None
         self.running = False
 
+        # 批量模式配置：每批最多batch_size条消息，最长等待batch_max_wait_ms毫秒
+        self.batch_enabled = os.getenv("VOTE_CONSUMER_BATCH_ENABLED", "false").lower() == "true"
+        self.batch_size = int(os.getenv("VOTE_CONSUMER_BATCH_SIZE", "1000"))
+        self.batch_max_wait_ms = int(os.getenv("VOTE_CONSUMER_BATCH_MAX_WAIT_MS", "200"))
+
+        # 分区并发配置：开启后每个分区独立处理批次，单个分区积压不阻塞其他分区
+        self.per_partition_enabled = os.getenv("VOTE_CONSUMER_PER_PARTITION", "false").lower() == "true"
+        self.partition_max_queued_batches = int(os.getenv("VOTE_CONSUMER_PARTITION_MAX_QUEUED", "4"))
+        # 分区被收回时等待积压批次处理完成的最长时间（秒），需小于再均衡超时
+        self.partition_drain_timeout = float(os.getenv("VOTE_CONSUMER_DRAIN_TIMEOUT", "10"))
+        self.partition_workers = {}
+
+        # 重试层级与死信队列：处理失败的消息转发到延迟重试topic，不阻塞主分区
+        self.retry_tiers = KafkaConfig.get_retry_tiers()
+        self.retry_group_id = f"{self.group_id}.retry"
+        self.retry_consumers = []
+        self.retry_tasks = []
+
     async def start(self):
         """启动消费者"""
         self.running = True
@@ -41,59 +128,201 @@ class VoteConsumer:
                 sig, lambda: asyncio.create_task(self.shutdown()))
 
         self.consumer = AIOKafkaConsumer(
-            self.topic,
             bootstrap_servers=self.bootstrap_servers,
             group_id=self.group_id,
             auto_offset_reset="earliest",  # 从最早的消息开始消费
-            enable_auto_commit=False,      # 禁用自动提交，我们将手动提交
-            value_deserializer=lambda x: json.loads(x.decode('utf-8'))
+            enable_auto_commit=False       # 禁用自动提交，我们将手动提交
+            # 不使用value_deserializer，保留原始字节以便原样转发到重试topic和死信队列
         )
 
+        # 订阅主题，分区并发模式下通过监听器管理每个分区的处理管道
+        listener = VoteRebalanceListener(self) if self.per_partition_enabled else None
+        self.consumer.subscribe([self.topic], listener=listener)
+
         # 启动消费者
         await self.consumer.start()
         print(f"Started consuming from {self.topic}...")
 
+        # 每个重试层级由独立的消费者按延迟处理
+        for topic, delay in self.retry_tiers:
+            self.retry_tasks.append(asyncio.create_task(
+                self.consume_retry_tier(topic, delay)))
+
         try:
-            # 消费消息
-            async for msg in self.consumer:
-                if not self.running:
-                    break
-
-                # 初始化重试计数
-                retry_count = 0
-                max_retries = 3
-                processed = False
-
-                # 重试机制
-                while retry_count < max_retries and not processed:
-                    try:
-                        # 处理消息
-                        await self.process_message(msg.value, msg.partition, msg.offset)
-
-                        # 标记为处理成功
-                        processed = True
-
-                        # 手动提交偏移量
-                        await self.consumer.commit()
-
-                    except Exception as e:
-                        retry_count += 1
-                        if retry_count >= max_retries:
-                            # 达到最大重试次数，记录错误并考虑发送到死信队列
-                            print(
-                                f"Failed to process message after {max_retries} attempts: {e}")
-                            await self.send_to_dead_letter_queue(msg.value, str(e))
-                            # 仍然提交偏移量，避免同一消息一直卡住消费进度
-                            await self.consumer.commit()
-                        else:
-                            # 等待一段时间后重试
-                            wait_time = 2 ** retry_count  # 指数退避策略
-                            print(
-                                f"Retry {retry_count}/{max_retries} after {wait_time}s. Error: {e}")
-                            await asyncio.sleep(wait_time)
+            if self.per_partition_enabled:
+                await self.consume_partitions()
+            elif self.batch_enabled:
+                await self.consume_batches()
+            else:
+                await self.consume_messages()
         finally:
             await self.shutdown()
 
+    async def consume_messages(self):
+        """逐条消费消息，处理失败的消息转发到重试topic后立即继续"""
+        # 消费消息
+        async for msg in self.consumer:
+            if not self.running:
+                break
+
+            await self.retry_until_success(lambda: self.process_or_route(msg))
+
+            # 手动提交偏移量
+            await self.consumer.commit()
+
+    async def consume_batches(self):
+        """批量消费消息：每批按用户名折叠为最高版本的票数，一条语句写入后统一提交偏移量"""
+        while self.running:
+            records = await self.consumer.getmany(
+                timeout_ms=self.batch_max_wait_ms, max_records=self.batch_size)
+            messages = [msg for partition_messages in records.values()
+                        for msg in partition_messages]
+            if not messages:
+                continue
+
+            await self.retry_until_success(
+                lambda: self.process_batch_messages(messages))
+
+            # 整批处理完成后提交一次偏移量
+            await self.consumer.commit()
+
+    async def consume_partitions(self):
+        """分区并发消费：主循环只负责拉取消息，按分区分发给各自的处理管道
+
+        每次按批拉取，管道内按VOTE_CONSUMER_BATCH_ENABLED批量处理或逐条处理。
+        """
+        while self.running:
+            records = await self.consumer.getmany(
+                timeout_ms=self.batch_max_wait_ms, max_records=self.batch_size)
+            for tp, messages in records.items():
+                self.get_partition_worker(tp).submit(messages)
+
+    def get_partition_worker(self, tp):
+        """获取分区的处理管道，不存在时创建"""
+        worker = self.partition_workers.get(tp)
+        if worker is None:
+            worker = PartitionWorker(self, tp, self.partition_max_queued_batches)
+            self.partition_workers[tp] = worker
+        return worker
+
+    async def stop_partition_workers(self, partitions):
+        """等待指定分区的积压批次处理完成（偏移量随之提交）后停止其处理管道"""
+        workers = [self.partition_workers.pop(tp) for tp in partitions
+                   if tp in self.partition_workers]
+        await asyncio.gather(*(worker.drain(self.partition_drain_timeout) for worker in workers))
+
+    async def consume_retry_tier(self, topic, delay):
+        """消费一个重试层级：等到消息的重试时间后再处理，再次失败时转发到下一层级或死信队列
+
+        同一层级的延迟相同，消息按重试时间有序，等待只阻塞该层级，不影响主topic。
+        """
+        consumer = AIOKafkaConsumer(
+            topic,
+            bootstrap_servers=self.bootstrap_servers,
+            group_id=self.retry_group_id,
+            auto_offset_reset="earliest",
+            enable_auto_commit=False
+        )
+        self.retry_consumers.append(consumer)
+        await consumer.start()
+        print(f"Started consuming retry tier {topic} (delay={delay}s)...")
+
+        async for msg in consumer:
+            if not self.running:
+                break
+
+            retry_at_ms = int(self.get_header(msg, "x-retry-at") or 0)
+            wait_time = retry_at_ms / 1000 - time.time()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+
+            await self.retry_until_success(lambda: self.process_or_route(msg))
+            await consumer.commit()
+
+    async def retry_until_success(self, operation):
+        """重复执行操作直到成功，用于PostgreSQL或Kafka暂不可用的情况（处理均为幂等）"""
+        while True:
+            try:
+                return await operation()
+            except Exception as e:
+                print(f"Operation failed, retrying in 1s: {e}")
+                await asyncio.sleep(1)
+
+    @staticmethod
+    def is_transient_error(e):
+        """连接类错误（例如PostgreSQL暂不可用）与消息内容无关，原地重试而不转发到重试层级，
+        避免故障期间的消息耗尽所有重试层级后进入死信队列"""
+        if isinstance(e, DBAPIError) and e.connection_invalidated:
+            return True
+        return isinstance(e, (OperationalError, InterfaceError, PoolTimeoutError, OSError, asyncio.TimeoutError))
+
+    async def process_or_route(self, msg):
+        """处理单条消息，数据错误时转发到重试层级或死信队列，连接类错误抛出由调用方原地重试"""
+        try:
+            events = decode_vote_events(msg.value)
+        except Exception as e:
+            # 无法解码的消息重试也不会成功，直接进入死信队列
+            await self.send_to_dead_letter_queue(msg, f"Undecodable message: {e}")
+            return
+
+        try:
+            for vote_data in events:
+                await self.process_message(vote_data, msg.partition, msg.offset)
+        except Exception as e:
+            if self.is_transient_error(e):
+                raise
+            await self.route_failure(msg, str(e))
+
+    async def process_batch_messages(self, messages):
+        """批量处理消息；整批失败时退回逐条处理，只有失败的消息被转发到重试层级，连接类错误抛出由调用方整批重试"""
+        decoded = []
+        undecodable = []
+        for msg in messages:
+            try:
+                decoded.append((msg, decode_vote_events(msg.value)))
+            except Exception as e:
+                undecodable.append((msg, f"Undecodable message: {e}"))
+
+        try:
+            await self.process_batch(self.fold_votes(decoded))
+        except Exception as e:
+            if self.is_transient_error(e):
+                raise
+            print(f"Batch failed, falling back to per-message processing: {e}")
+            for msg, events in decoded:
+                try:
+                    await self.process_batch(self.fold_votes([(msg, events)]))
+                except Exception as e:
+                    if self.is_transient_error(e):
+                        raise
+                    await self.route_failure(msg, str(e))
+
+        # 无法解码的消息重试也不会成功，直接进入死信队列；写入成功后再转发，整批重试时不会重复转发
+        for msg, reason in undecodable:
+            await self.send_to_dead_letter_queue(msg, reason)
+
+    def fold_votes(self, decoded):
+        """将一批 (消息, 投票事件列表) 折叠为 {username: (count, version)}，每个用户只保留版本号最高的票数"""
+        latest_votes = {}
+        for msg, events in decoded:
+            for vote_data in events:
+                username = vote_data.get('target')
+                if not username:
+                    print(f"Invalid vote data: missing username (partition={msg.partition}, offset={msg.offset})")
+                    continue
+                count = vote_data.get('count', 1)
+                version = vote_data.get('version', 1)
+                if username not in latest_votes or version > latest_votes[username][1]:
+                    latest_votes[username] = (count, version)
+        return latest_votes
+
+    async def process_batch(self, latest_votes):
+        """使用带版本保护的 INSERT ... ON CONFLICT DO UPDATE 批量写入票数"""
+        async with async_session() as session:
+            await upsert_votes(session, latest_votes)
+            await session.commit()
+        print(f"Upserted votes for {len(latest_votes)} users")
+
     async def process_message(self, vote_data, partition, offset):
         """处理单个投票消息"""
         print(
@@ -142,30 +371,70 @@ class VoteConsumer:
                 await session.commit()
         except Exception as e:
             print(f"Error processing vote: {str(e)}")
+            # 抛出异常，由调用方转发到重试层级
+            raise
 
     async def shutdown(self):
         """关闭消费者"""
         print("Shutting down consumer...")
         self.running = False
+        # 处理完各分区积压的批次并提交偏移量
+        await self.stop_partition_workers(list(self.partition_workers))
+        for task in self.retry_tasks:
+            task.cancel()
+        for consumer in self.retry_consumers:
+            await consumer.stop()
+        self.retry_tasks, self.retry_consumers = [], []
         if self.consumer:
             await self.consumer.stop()
+        await KafkaConfig.close_producer()
 
-    async def send_to_dead_letter_queue(self, message, error_reason):
-        """发送失败消息到死信队列，方便后续处理和分析"""
-        try:
-            dlq_message = {
-                "original_message": message,
-                "error": error_reason,
-                "timestamp": str(datetime.datetime.now())
-            }
-            print(f"Message sent to dead letter queue: {dlq_message}")
-
-            # TODO: 实际发送到死信队列的代码
-            # 例如：
-            # await producer.send_and_wait("vote_dlq", json.dumps(dlq_message).encode("utf-8"))
-        except Exception as e:
-            print(f"Failed to send message to dead letter queue: {e}")
+    @staticmethod
+    def get_header(msg, name):
+        """读取消息头，不存在时返回None"""
+        for key, value in msg.headers or ():
+            if key == name:
+                return value.decode('utf-8')
+        return None
+
+    async def route_failure(self, msg, error_reason):
+        """将处理失败的消息转发到下一个重试层级，所有层级都失败后发送到死信队列"""
+        retry_count = int(self.get_header(msg, "x-retry-count") or 0)
+        if retry_count >= len(self.retry_tiers):
+            await self.send_to_dead_letter_queue(msg, error_reason)
+            return
+
+        topic, delay = self.retry_tiers[retry_count]
+        await self.forward_message(msg, topic, error_reason, retry_count + 1,
+                                   retry_at_ms=int((time.time() + delay) * 1000))
+        print(f"Message (partition={msg.partition}, offset={msg.offset}) scheduled for retry in {delay}s: {error_reason}")
+
+    async def send_to_dead_letter_queue(self, msg, error_reason):
+        """发送失败消息到死信队列，保留原始消息头、分区和偏移量，方便后续分析和重放"""
+        retry_count = int(self.get_header(msg, "x-retry-count") or 0)
+        await self.forward_message(msg, KafkaConfig.VOTES_DLQ_TOPIC, error_reason, retry_count)
+        print(f"Message (partition={msg.partition}, offset={msg.offset}) sent to dead letter queue: {error_reason}")
+
+    async def forward_message(self, msg, topic, error_reason, retry_count, retry_at_ms=None):
+        """将原始消息连同失败信息转发到指定topic，等待broker确认后才返回"""
+        # 消息首次失败时记录其原始位置，之后的转发沿用
+        original = {
+            "x-original-topic": self.get_header(msg, "x-original-topic") or msg.topic,
+            "x-original-partition": self.get_header(msg, "x-original-partition") or str(msg.partition),
+            "x-original-offset": self.get_header(msg, "x-original-offset") or str(msg.offset)
+        }
+        headers = [(key, value) for key, value in msg.headers or () if not key.startswith("x-")]
+        headers += [(key, value.encode('utf-8')) for key, value in original.items()]
+        headers += [
+            ("x-retry-count", str(retry_count).encode('utf-8')),
+            ("x-error", error_reason.encode('utf-8')),
+            ("x-failed-at", str(datetime.datetime.now()).encode('utf-8'))
+        ]
+        if retry_at_ms is not None:
+            headers.append(("x-retry-at", str(retry_at_ms).encode('utf-8')))
 
+        producer = await KafkaConfig.get_producer()
+        await producer.send_and_wait(topic, value=msg.value, key=msg.key, headers=headers)
 
 async def main():
     """主函数"""
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+票数对账服务入口点
+
+持续比较Redis中的user_votes与PostgreSQL中的votes表，发现丢失的Kafka事件等导致的不一致：
+- Redis → PostgreSQL：HSCAN分块扫描user_votes，批量查询数据库中的对应行
+- PostgreSQL → Redis：按用户名keyset分页扫描votes表，检查Redis中是否缺少该用户
+Redis中的票数领先数据库是正常的消费延迟，不一致的用户先记录快照，宽限期后重新读取两侧再确认：
+- 两侧票数已一致：消费者已追上
+- 数据库版本号高于Redis分片当前的版本号：Redis丢失了已发出的写入（例如故障转移），Redis落后于数据库
+- Redis中的票数自快照后有变化，或数据库已写入快照之后的事件：用户仍在被投票，重新记录快照
+- 其余情况确认为数据库漂移
+开启修复时按版本号写入快照（数据库中版本号更高的行不会被覆盖）；Redis落后时将数据库的票数写回Redis
+（票数仍为读取时的值才写入），并把分片版本号提高到数据库的版本号，之后的投票不会因版本号过低被消费者忽略。
+扫描速度受限于每秒检查的用户数，可以在生产环境中持续运行。
+"""
+
+import asyncio
+import os
+import signal
+import time
+
+from ..config.redis import RedisConfig
+from ..database.db import async_session, get_votes_by_usernames, get_votes_page, upsert_votes
+from ..services.rehydration_service import rehydration_service
+from ..services.script_registry import script_registry
+from ..services.vote_shards import vote_shards
+
+# Lua脚本：将数据库中的票数写回Redis，票数仍为对账时读取的值才覆盖，并同步排行榜；
+# 分片版本号提高到数据库中的版本号
+# ARGV按 用户名, 读取时的票数, 数据库票数, 数据库版本号 依次排列
+REPAIR_REDIS_SCRIPT = """
+local repaired = 0
+for i = 1, #ARGV, 4 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        redis.call('ZADD', KEYS[2], ARGV[i + 2], ARGV[i])
+        repaired = repaired + 1
+    end
+    if tonumber(redis.call('GET', KEYS[3]) or '0') < tonumber(ARGV[i + 3]) then
+        redis.call('SET', KEYS[3], ARGV[i + 3])
+    end
+end
+return repaired
+"""
+
+
+class VoteReconciler:
+    """Redis与PostgreSQL票数对账器"""
+
+    def __init__(self):
+        self.redis = RedisConfig.get_redis()
+        self.user_votes_key = "user_votes"
+        self.vote_version_key = "vote_version"
+        self.leaderboard_key = rehydration_service.leaderboard_key
+        script_registry.register("repair_redis_votes", REPAIR_REDIS_SCRIPT)
+        self.stats_key = "vote_reconcile_stats"  # 对账统计，由主服务的/metrics/reconcile读取
+        # 从环境变量获取配置，如果没有则使用默认值
+        self.chunk_size = int(os.getenv("VOTE_RECONCILE_CHUNK_SIZE", "500"))  # 每块检查的用户数
+        self.rate = float(os.getenv("VOTE_RECONCILE_RATE", "2000"))  # 每秒最多检查的用户数
+        self.grace_seconds = float(os.getenv("VOTE_RECONCILE_GRACE", "60"))  # 确认漂移前的宽限期（秒）
+        self.interval = float(os.getenv("VOTE_RECONCILE_INTERVAL", "300"))  # 两轮扫描之间的间隔（秒）
+        self.repair = os.getenv("VOTE_RECONCILE_REPAIR", "false").lower() == "true"
+        self.max_suspects = int(os.getenv("VOTE_RECONCILE_MAX_SUSPECTS", "100000"))
+        self.suspects = {}  # {username: (redis_count, vote_version, 首次发现时间)}
+        self.running = False
+        self._stop_event = None
+        self.stats = {
+            "cycles": 0,
+            "checked": 0,
+            "drifted": 0,
+            "missing_in_db": 0,
+            "missing_in_redis": 0,
+            "redis_behind": 0,
+            "repaired": 0
+        }
+
+    async def start(self):
+        """启动对账循环"""
+        self.running = True
+        self._stop_event = asyncio.Event()
+
+        # 设置信号处理器用于优雅关闭
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        print(f"Started vote reconciler (rate={self.rate}/s, repair={self.repair})...")
+        try:
+            while self.running:
+                try:
+                    # Redis中的票数恢复完成之前对账没有意义
+                    if await rehydration_service.is_ready():
+                        await self.run_cycle()
+                except Exception as e:
+                    print(f"Error reconciling votes: {e}")
+                await self.sleep(self.interval)
+        finally:
+            await RedisConfig.close_redis()
+
+    async def run_cycle(self):
+        """执行一轮完整扫描"""
+        start_time = time.monotonic()
+        cycle = {key: 0 for key in self.stats if key != "cycles"}
+
+        # Redis → PostgreSQL，逐个分片扫描
+        for shard in range(vote_shards.count):
+            cursor = 0
+            while self.running:
+                cursor, fields = await self.redis.hscan(
+                    vote_shards.key(self.user_votes_key, shard), cursor, count=self.chunk_size)
+                if fields:
+                    await self.check_redis_chunk(list(fields), cycle, shard)
+                    await self.throttle(len(fields))
+                if cursor == 0:
+                    break
+
+        # PostgreSQL → Redis
+        after_username = ""
+        while self.running:
+            rows = await get_votes_page(after_username, self.chunk_size)
+            if not rows:
+                break
+            await self.check_db_page(rows, cycle)
+            after_username = rows[-1][0]
+            await self.throttle(len(rows))
+
+        await self.confirm_suspects(cycle)
+
+        self.stats["cycles"] += 1
+        for key, value in cycle.items():
+            self.stats[key] += value
+        await self.redis.hset(self.stats_key, mapping={
+            **self.stats,
+            "suspects": len(self.suspects),
+            "last_cycle_drifted": (cycle["drifted"] + cycle["missing_in_db"] + cycle["missing_in_redis"]
+                                   + cycle["redis_behind"]),
+            "last_cycle_seconds": round(time.monotonic() - start_time, 1),
+            "last_cycle_at": int(time.time())
+        })
+        print(f"Reconcile cycle finished: {cycle}, {len(self.suspects)} suspects pending")
+
+    async def read_redis(self, usernames, shard):
+        """读取同一分片中用户的票数与分片版本号"""
+        # 票数和版本号在同一个事务中读取，快照中的票数恰好是该版本号时的总票数
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hmget(vote_shards.key(self.user_votes_key, shard), usernames)
+            pipe.get(vote_shards.key(self.vote_version_key, shard))
+            counts, version = await pipe.execute()
+        return counts, int(version or 0)
+
+    async def check_redis_chunk(self, usernames, cycle, shard=0):
+        """比较一块Redis用户（同一分片）与数据库中的票数，不一致的用户记录快照等待确认"""
+        counts, version = await self.read_redis(usernames, shard)
+
+        db_votes = await get_votes_by_usernames(usernames)
+        now = time.monotonic()
+        for username, count in zip(usernames, counts):
+            if count is None:
+                continue
+            cycle["checked"] += 1
+            db_row = db_votes.get(username)
+            if db_row is not None and db_row[0] == int(count):
+                self.suspects.pop(username, None)
+            elif username not in self.suspects and len(self.suspects) < self.max_suspects:
+                self.suspects[username] = (int(count), version, now)
+
+    async def check_db_page(self, rows, cycle):
+        """检查数据库中的用户在Redis中是否存在"""
+        groups = vote_shards.group([username for username, _, _ in rows])
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard, indices in groups.items():
+                pipe.hmget(vote_shards.key(self.user_votes_key, shard), [rows[i][0] for i in indices])
+            results = await pipe.execute()
+        counts = [None] * len(rows)
+        for indices, shard_counts in zip(groups.values(), results):
+            for i, count in zip(indices, shard_counts):
+                counts[i] = count
+        missing = {username: count for (username, count, _), redis_count in zip(rows, counts)
+                   if redis_count is None}
+        if not missing:
+            return
+
+        cycle["missing_in_redis"] += len(missing)
+        print(f"Users missing in Redis: {list(missing)[:10]}{' ...' if len(missing) > 10 else ''}")
+        if self.repair:
+            # HSETNX/ZADD NX不会覆盖期间新写入的票数，排行榜与总票数一起补齐
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for username, count in missing.items():
+                    pipe.hsetnx(vote_shards.key_for(self.user_votes_key, username), username, count)
+                    pipe.zadd(vote_shards.key_for(self.leaderboard_key, username), {username: count}, nx=True)
+                await pipe.execute()
+            cycle["repaired"] += len(missing)
+
+    async def confirm_suspects(self, cycle):
+        """宽限期后重新读取Redis与数据库，仍不一致且不是因为用户还在被投票的确认为漂移，按配置修复"""
+        now = time.monotonic()
+        due = [username for username, (_, _, seen) in self.suspects.items()
+               if now - seen >= self.grace_seconds]
+
+        for start in range(0, len(due), self.chunk_size):
+            chunk = due[start:start + self.chunk_size]
+            current = {}
+            for shard, indices in vote_shards.group(chunk).items():
+                shard_usernames = [chunk[i] for i in indices]
+                counts, version = await self.read_redis(shard_usernames, shard)
+                for username, count in zip(shard_usernames, counts):
+                    current[username] = (count, version)
+            db_votes = await get_votes_by_usernames(chunk)
+
+            repairs = {}
+            redis_repairs = {}
+            for username in chunk:
+                count, version, _ = self.suspects.pop(username)
+                redis_count, redis_version = current[username]
+                db_row = db_votes.get(username)
+                if redis_count is None:
+                    # 已从Redis中删除，由PostgreSQL → Redis方向的扫描处理
+                    continue
+                redis_count = int(redis_count)
+                if db_row is not None and db_row[0] == redis_count:
+                    # 消费者已追上
+                    continue
+                if db_row is not None and db_row[1] > redis_version:
+                    # 数据库中的事件版本号Redis从未发出过，Redis丢失了已转发的写入
+                    cycle["redis_behind"] += 1
+                    print(f"Redis behind PostgreSQL for {username}: redis={redis_count}@{redis_version}, db={db_row}")
+                    redis_repairs.setdefault(vote_shards.shard_of(username), []).extend(
+                        [username, redis_count, db_row[0], db_row[1]])
+                    continue
+                if redis_count != count or (db_row is not None and db_row[1] >= version):
+                    # 快照之后仍有投票，消费延迟是正常的，重新记录快照
+                    if len(self.suspects) < self.max_suspects:
+                        self.suspects[username] = (redis_count, redis_version, now)
+                    continue
+                if db_row is None:
+                    cycle["missing_in_db"] += 1
+                else:
+                    cycle["drifted"] += 1
+                print(f"Vote drift for {username}: redis={count}@{version}, db={db_row}")
+                repairs[username] = (count, version)
+
+            if self.repair:
+                if repairs:
+                    async with async_session() as session:
+                        await upsert_votes(session, repairs)
+                        await session.commit()
+                    cycle["repaired"] += len(repairs)
+                for shard, args in redis_repairs.items():
+                    cycle["repaired"] += await script_registry.evalsha("repair_redis_votes", [
+                        vote_shards.key(self.user_votes_key, shard),
+                        vote_shards.key(self.leaderboard_key, shard),
+                        vote_shards.key(self.vote_version_key, shard)
+                    ], args)
+            await self.throttle(len(chunk))
+
+    async def throttle(self, checked):
+        """按每秒检查的用户数限速"""
+        if self.rate > 0:
+            await self.sleep(checked / self.rate)
+
+    async def sleep(self, seconds):
+        """可被stop()打断的等待"""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        """停止对账循环"""
+        print("Shutting down vote reconciler...")
+        self.running = False
+        self._stop_event.set()
+
+
+async def main():
+    """主函数"""
+    reconciler = VoteReconciler()
+    await reconciler.start()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+从PostgreSQL恢复Redis中的票数
+
+Redis数据丢失后，投票会被拒绝、查询回退到PostgreSQL，直到票数恢复完成。
+主服务启动时会自动执行恢复，也可以通过本工具手动执行。
+
+用法:
+    python -m app.workers.vote_rehydrate [--batch-size N]
+"""
+
+import argparse
+import asyncio
+
+from ..config.redis import RedisConfig
+from ..database.db import init_db
+from ..services.rehydration_service import rehydration_service
+
+
+async def rehydrate():
+    """执行恢复直到Redis中的票数就绪"""
+    try:
+        await init_db()
+        await rehydration_service.ensure_rehydrated()
+        print(f"Vote rehydration status: {rehydration_service.get_stats()}")
+    finally:
+        await RedisConfig.close_redis()
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description="Rehydrate Redis vote totals from PostgreSQL")
+    parser.add_argument("--batch-size", type=int, default=None, help="每次管道写入的用户数")
+    args = parser.parse_args()
+    if args.batch_size:
+        rehydration_service.batch_size = args.batch_size
+    asyncio.run(rehydrate())
+
+
+if __name__ == "__main__":
+    main()
@@ -52,7 +52,7 @@ kubectl apply -k k8s/
 
 # 等待服务启动
 echo -e "${YELLOW}[INFO] 等待服务启动...${NC}"
-kubectl -n cast wait --for=condition=available --timeout=300s deployment/main-service deployment/ticket-generator deployment/vote-consumer
+kubectl -n cast wait --for=condition=available --timeout=300s deployment/main-service deployment/ticket-generator deployment/vote-consumer deployment/outbox-relay deployment/vote-reconciler deployment/audit-writer
 
 # 获取服务信息
 echo -e "${GREEN}[SUCCESS] 部署完成!${NC}"
@@ -0,0 +1,58 @@
+import fakeredis
+import pytest
+
+from app.config.redis import RedisConfig
+
+# 所有服务共享同一个客户端，导入服务之前替换为fakeredis（带lupa，可以执行Lua脚本）
+RedisConfig._instance = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+from app.services.script_registry import script_registry  # noqa: E402
+from app.services.ticket_generator_service import ticket_generator_service  # noqa: E402
+from app.services.vote_service import vote_service  # noqa: E402
+from app.services.vote_shards import vote_shards  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def redis():
+    """清空的fakeredis，脚本已加载"""
+    client = RedisConfig.get_redis()
+    await client.flushall()
+    await script_registry.load_all()
+    yield client
+    await vote_service.stripes.close()
+    await vote_service.cache.close()
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    """将票数分片数设置为n，返回设置函数"""
+    def set_shards(count):
+        monkeypatch.setattr(vote_shards, "count", count)
+    return set_shards
+
+
+@pytest.fixture
+def kafka_events(monkeypatch):
+    """截获投票服务发送到Kafka的事件"""
+    events = []
+
+    async def capture(usernames, vote_counts, ticket, voter_username=None, timestamp=None, version=None):
+        events.append((list(usernames), list(vote_counts), version))
+    monkeypatch.setattr(vote_service, "_send_vote_events_to_kafka", capture)
+    return events
+
+
+async def mark_ready(client):
+    """设置所有分片的就绪标记"""
+    for shard in range(vote_shards.count):
+        await client.set(vote_shards.key("vote_state_ready", shard), 1)
+        await client.set(vote_shards.key("vote_version", shard), 0)
+
+
+async def new_ticket():
+    return (await ticket_generator_service.generate_new_ticket())["id"]
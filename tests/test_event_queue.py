@@ -0,0 +1,85 @@
+import asyncio
+import os
+
+import pytest
+
+from app.services.event_queue import VoteEventQueue
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def spill_queue(tmp_path, monkeypatch):
+    """spill策略、容量为1的队列，返回 (队列, 已发送的事件, 设置发送是否失败的函数)"""
+    monkeypatch.setenv("VOTE_EVENT_QUEUE_POLICY", "spill")
+    monkeypatch.setenv("VOTE_EVENT_QUEUE_SIZE", "1")
+    monkeypatch.setenv("VOTE_EVENT_SPILL_PATH", str(tmp_path / "spill" / "vote_events.spill"))
+    published = []
+    failing = {"value": False}
+
+    async def publish(batch):
+        if failing["value"]:
+            raise ConnectionError("kafka down")
+        published.extend(batch)
+
+    def set_failing(value):
+        failing["value"] = value
+    return VoteEventQueue(publish), published, set_failing
+
+
+async def wait_until(condition, timeout=3.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+async def test_failed_replay_is_retried_without_new_events(spill_queue):
+    queue, published, set_failing = spill_queue
+    set_failing(True)
+    await queue.put({"id": 1}, await queue.reserve())
+    await queue.put({"id": 2}, await queue.reserve())
+    assert os.path.exists(queue.spill_path)
+
+    # Kafka恢复后没有新的请求，磁盘中的事件仍然被补发
+    set_failing(False)
+    await wait_until(lambda: len(published) == 2)
+    await wait_until(lambda: not os.path.exists(queue.spill_path) and not os.path.exists(queue.replay_path))
+    assert sorted(event["id"] for event in published) == [1, 2]
+    await queue.close()
+
+
+async def test_close_spills_unsent_events_and_start_replays_them(spill_queue):
+    queue, published, set_failing = spill_queue
+    set_failing(True)
+    await queue.put({"id": 1}, await queue.reserve())
+    await queue.close(timeout=0.1)
+    assert not published
+    assert os.path.exists(queue.spill_path) or os.path.exists(queue.replay_path)
+
+    # 重启后的新队列补发上次遗留的事件
+    restarted_published = []
+
+    async def publish(batch):
+        restarted_published.extend(batch)
+    restarted = VoteEventQueue(publish)
+    restarted.start()
+    await wait_until(lambda: restarted_published == [{"id": 1}])
+    await restarted.close()
+
+
+async def test_spill_during_replay_is_not_lost(spill_queue):
+    queue, published, set_failing = spill_queue
+    set_failing(True)
+    await queue.put({"id": 1}, await queue.reserve())
+    await queue.put({"id": 2}, await queue.reserve())
+
+    # 补发与新的磁盘写入并发进行，写入的事件不会落在已读取的文件中
+    set_failing(False)
+    for i in range(3, 23):
+        await queue.put({"id": i}, False)
+        await asyncio.sleep(0)
+    await wait_until(lambda: len(published) == 22)
+    await wait_until(lambda: not os.path.exists(queue.spill_path) and not os.path.exists(queue.replay_path))
+    assert sorted(event["id"] for event in published) == list(range(1, 23))
+    await queue.close()
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from app.services import rehydration_service as rehydration_module
+from app.services.rehydration_service import rehydration_service
+from app.services.vote_service import vote_service
+from app.services.vote_shards import vote_shards
+from conftest import new_ticket
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def watching(redis, monkeypatch, kafka_events):
+    """数据库中alice有5票（版本号10），启动后台恢复与检查任务"""
+    async def iter_vote_batches(batch_size):
+        yield [("alice", 5, 10)]
+    monkeypatch.setattr(rehydration_module, "iter_vote_batches", iter_vote_batches)
+    monkeypatch.setattr(rehydration_service, "watch_interval", 60)
+    await rehydration_service.start()
+    yield rehydration_service
+    await rehydration_service.stop()
+
+
+async def wait_until_ready():
+    async def poll():
+        while not await rehydration_service.is_ready():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout=2)
+
+
+async def test_redis_data_loss_while_running_is_rehydrated(redis, watching):
+    assert await vote_service.get_users_votes(["alice"]) == [5]
+
+    # 服务运行中Redis丢失数据，投票被拒绝并立即触发恢复（不等待检查间隔）
+    await redis.flushall()
+    result = await vote_service.vote_for_users(["alice"], [1], await new_ticket())
+    assert not result["success"]
+    await wait_until_ready()
+
+    result = await vote_service.vote_for_users(["alice"], [1], await new_ticket())
+    assert result["success"]
+    assert result["votes"] == [6]
+    assert result["version"] == 11
+
+
+async def test_only_shards_that_lost_data_are_rehydrated(redis, shards, watching):
+    shards(4)
+    await rehydration_service.stop()
+    await redis.flushall()
+    await rehydration_service.start()
+    # 其他分片上的用户在数据库之后有新的投票
+    other = next(f"user{i}" for i in range(100) if vote_shards.shard_of(f"user{i}") != vote_shards.shard_of("alice"))
+    assert (await vote_service.vote_for_users([other], [3], await new_ticket()))["success"]
+
+    lost = vote_shards.shard_of("alice")
+    for name in ["user_votes", "vote_version", "vote_state_ready", "vote_leaderboard", "vote_leaderboard_ready"]:
+        await redis.delete(vote_shards.key(name, lost))
+    assert not (await vote_service.vote_for_users(["alice"], [1], await new_ticket()))["success"]
+    await wait_until_ready()
+
+    assert await vote_service.get_users_votes(["alice", other]) == [5, 3]
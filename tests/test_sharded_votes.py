@@ -0,0 +1,78 @@
+import pytest
+
+from app.services.vote_service import vote_service
+from app.services.vote_shards import vote_shards
+from conftest import mark_ready, new_ticket
+
+pytestmark = pytest.mark.anyio
+
+
+def usernames_on_different_shards():
+    """两个位于不同分片的用户名"""
+    first = "user0"
+    for i in range(1, 100):
+        if vote_shards.shard_of(f"user{i}") != vote_shards.shard_of(first):
+            return first, f"user{i}"
+
+
+async def usage_count(redis, ticket):
+    return int(await redis.hget(f"ticket:{ticket}", "usageCount"))
+
+
+async def test_sharded_vote_applies_all_shards(redis, shards, kafka_events):
+    shards(4)
+    await mark_ready(redis)
+    first, second = usernames_on_different_shards()
+    ticket = await new_ticket()
+
+    result = await vote_service.vote_for_users([first, second], [2, 3], ticket)
+
+    assert result["success"]
+    assert result["votes"] == [2, 3]
+    assert await vote_service.get_users_votes([first, second]) == [2, 3]
+    assert await usage_count(redis, ticket) == 1
+    assert kafka_events == [([first, second], [2, 3], [1, 1])]
+
+
+async def test_unready_shard_rejects_without_consuming_ticket(redis, shards, kafka_events):
+    shards(4)
+    await mark_ready(redis)
+    first, second = usernames_on_different_shards()
+    await redis.delete(vote_shards.key_for("vote_state_ready", second))
+    ticket = await new_ticket()
+
+    result = await vote_service.vote_for_users([first, second], [2, 3], ticket)
+
+    assert not result["success"]
+    assert "warming up" in result["message"]
+    assert await redis.hget(vote_shards.key_for("user_votes", first), first) is None
+    assert await usage_count(redis, ticket) == 0
+    assert kafka_events == []
+
+
+async def test_partial_shard_failure_is_undone_and_ticket_refunded(redis, shards, kafka_events, monkeypatch):
+    shards(4)
+    await mark_ready(redis)
+    first, second = usernames_on_different_shards()
+    ticket = await new_ticket()
+
+    # 就绪检查通过后，第二个用户所在的分片执行失败
+    execute_votes = vote_service._execute_votes
+    failing_shard = vote_shards.shard_of(second)
+
+    async def failing_execute(requests, shard=0, tickets_consumed=False):
+        if shard == failing_shard and requests[0]["votes"][0] > 0:
+            return [{"success": False, "message": "Vote service is warming up, please retry later"}]
+        return await execute_votes(requests, shard, tickets_consumed)
+    monkeypatch.setattr(vote_service, "_execute_votes", failing_execute)
+
+    result = await vote_service.vote_for_users([first, second], [2, 3], ticket, "voter")
+
+    assert not result["success"]
+    assert await vote_service.get_users_votes([first, second]) == [0, 0]
+    assert await redis.zscore(vote_shards.key_for("vote_leaderboard", first), first) == 0
+    assert await usage_count(redis, ticket) == 0
+    assert kafka_events == []
+    # 审计中保留投票和撤销两条记录
+    audit = await redis.xrange(vote_shards.key_for("vote_audit", first))
+    assert [int(fields["count"]) for _, fields in audit] == [2, -2]
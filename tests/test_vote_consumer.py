@@ -0,0 +1,132 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.workers.vote_consumer import PartitionWorker, VoteConsumer
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeKafkaConsumer:
+    def __init__(self):
+        self.commits = []
+
+    async def commit(self, offsets):
+        self.commits.append(offsets)
+
+    def pause(self, tp):
+        pass
+
+    def resume(self, tp):
+        pass
+
+    def paused(self):
+        return set()
+
+
+@pytest.fixture
+def owner(monkeypatch):
+    monkeypatch.setenv("VOTE_CONSUMER_BATCH_ENABLED", "false")
+    consumer = VoteConsumer()
+    consumer.consumer = FakeKafkaConsumer()
+    return consumer
+
+
+def message(offset):
+    return SimpleNamespace(offset=offset, partition=0, value=b"")
+
+
+async def test_drain_times_out_without_committing(owner, monkeypatch):
+    async def database_down(messages):
+        raise ConnectionError("database down")
+    monkeypatch.setattr(owner, "batch_enabled", True)
+    monkeypatch.setattr(owner, "process_batch_messages", database_down)
+    worker = PartitionWorker(owner, "votes-0", 4)
+    worker.submit([message(0), message(1)])
+
+    await asyncio.wait_for(worker.drain(0.1), timeout=1)
+
+    assert worker.task.done()
+    assert owner.consumer.commits == []
+
+
+async def test_partition_worker_processes_messages_one_by_one_when_batching_is_off(owner, monkeypatch):
+    processed = []
+
+    async def process_or_route(msg):
+        processed.append(msg.offset)
+    monkeypatch.setattr(owner, "process_or_route", process_or_route)
+    worker = PartitionWorker(owner, "votes-0", 4)
+    worker.submit([message(0), message(1)])
+
+    await worker.drain(1)
+
+    assert processed == [0, 1]
+    assert owner.consumer.commits == [{"votes-0": 2}]
+
+
+@pytest.fixture
+def routed(owner, monkeypatch):
+    """记录转发到重试层级和死信队列的消息，返回 {"retry": [...], "dlq": [...]}"""
+    routed = {"retry": [], "dlq": []}
+
+    async def route_failure(msg, error_reason):
+        routed["retry"].append(msg.offset)
+
+    async def send_to_dead_letter_queue(msg, error_reason):
+        routed["dlq"].append(msg.offset)
+    monkeypatch.setattr(owner, "route_failure", route_failure)
+    monkeypatch.setattr(owner, "send_to_dead_letter_queue", send_to_dead_letter_queue)
+    return routed
+
+
+def vote_message(offset):
+    return SimpleNamespace(offset=offset, partition=0, value=b'{"target": "alice", "count": 1, "version": 1}')
+
+
+async def test_database_outage_is_retried_in_place_instead_of_routed(owner, routed, monkeypatch):
+    attempts = []
+
+    async def process_message(vote_data, partition, offset):
+        attempts.append(offset)
+        if len(attempts) == 1:
+            raise ConnectionRefusedError("database down")
+    monkeypatch.setattr(owner, "process_message", process_message)
+
+    await owner.retry_until_success(lambda: owner.process_or_route(vote_message(0)))
+
+    assert attempts == [0, 0]
+    assert routed == {"retry": [], "dlq": []}
+
+
+async def test_data_error_is_routed_to_retry_tier(owner, routed, monkeypatch):
+    async def process_message(vote_data, partition, offset):
+        raise ValueError("bad vote")
+    monkeypatch.setattr(owner, "process_message", process_message)
+
+    await owner.process_or_route(vote_message(0))
+
+    assert routed == {"retry": [0], "dlq": []}
+
+
+async def test_undecodable_message_goes_straight_to_dead_letter_queue(owner, routed):
+    await owner.process_or_route(SimpleNamespace(offset=0, partition=0, value=b"\xff"))
+
+    assert routed == {"retry": [], "dlq": [0]}
+
+
+async def test_batch_outage_is_retried_without_routing(owner, routed, monkeypatch):
+    attempts = []
+
+    async def process_batch(latest_votes):
+        attempts.append(latest_votes)
+        if len(attempts) == 1:
+            raise ConnectionRefusedError("database down")
+    monkeypatch.setattr(owner, "process_batch", process_batch)
+    messages = [vote_message(0), SimpleNamespace(offset=1, partition=0, value=b"\xff")]
+
+    await owner.retry_until_success(lambda: owner.process_batch_messages(messages))
+
+    assert len(attempts) == 2
+    assert routed == {"retry": [], "dlq": [1]}
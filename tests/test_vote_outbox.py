@@ -0,0 +1,64 @@
+import pytest
+
+from app.services.vote_service import vote_service
+from app.services.vote_shards import vote_shards
+from app.workers.outbox_relay import OutboxRelay
+from conftest import mark_ready, new_ticket
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    """开启发件箱，积压上限为2"""
+    monkeypatch.setattr(vote_service, "outbox_enabled", True)
+    monkeypatch.setattr(vote_service, "outbox_maxlen", 2)
+
+
+async def test_full_outbox_rejects_votes_without_trimming(redis, shards, outbox):
+    shards(1)
+    await mark_ready(redis)
+    for username in ["a", "b"]:
+        assert (await vote_service.vote_for_users([username], [1], await new_ticket()))["success"]
+    ticket = await new_ticket()
+    used = await redis.hget(f"ticket:{ticket}", "usageCount")
+
+    result = await vote_service.vote_for_users(["c"], [1], ticket)
+
+    assert not result["success"]
+    assert "overloaded" in result["message"]
+    assert await redis.hget(f"ticket:{ticket}", "usageCount") == used
+    # 尚未转发的事件全部保留
+    entries = await redis.xrange("vote_outbox")
+    assert [fields["usernames"] for _, fields in entries] == ['["a"]', '["b"]']
+
+
+async def test_full_outbox_on_one_shard_is_undone_and_refunded(redis, shards, outbox):
+    shards(4)
+    await mark_ready(redis)
+    first, second = "user0", next(f"user{i}" for i in range(1, 100)
+                                  if vote_shards.shard_of(f"user{i}") != vote_shards.shard_of("user0"))
+    full = vote_shards.key_for("vote_outbox", second)
+    await redis.xadd(full, {"usernames": "[]"})
+    await redis.xadd(full, {"usernames": "[]"})
+    ticket = await new_ticket()
+
+    result = await vote_service.vote_for_users([first, second], [2, 3], ticket)
+
+    assert not result["success"]
+    assert await vote_service.get_users_votes([first, second]) == [0, 0]
+    assert int(await redis.hget(f"ticket:{ticket}", "usageCount")) == 0
+
+
+async def test_relay_counts_deleted_pending_entries(redis, shards):
+    shards(1)
+    relay = OutboxRelay()
+    relay.claim_idle_ms = 0
+    await relay.ensure_group()
+    entry_id = await redis.xadd("vote_outbox", {"usernames": "[]"})
+    # 其他实例读取后崩溃，消息随后被删除
+    await redis.xreadgroup(relay.group_name, "crashed", {"vote_outbox": ">"})
+    await redis.xdel("vote_outbox", entry_id)
+
+    assert await relay.read_batch("vote_outbox") == []
+    assert await redis.hget(relay.stats_key, "trimmed") == "1"
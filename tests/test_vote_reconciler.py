@@ -0,0 +1,123 @@
+import contextlib
+
+import pytest
+
+from app.services.vote_shards import vote_shards
+from app.workers import vote_reconciler
+from app.workers.vote_reconciler import VoteReconciler
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def reconciler(redis, monkeypatch):
+    """开启修复、宽限期为0的对账器，数据库替换为字典，返回 (对账器, 数据库票数, 写入数据库的修复)"""
+    instance = VoteReconciler()
+    monkeypatch.setattr(instance, "repair", True)
+    monkeypatch.setattr(instance, "grace_seconds", 0)
+    monkeypatch.setattr(instance, "rate", 0)
+    db = {}
+    upserts = {}
+
+    async def get_votes_by_usernames(usernames):
+        return {username: db[username] for username in usernames if username in db}
+
+    async def upsert_votes(session, votes):
+        upserts.update(votes)
+
+    @contextlib.asynccontextmanager
+    async def async_session():
+        class Session:
+            async def commit(self):
+                pass
+        yield Session()
+    monkeypatch.setattr(vote_reconciler, "get_votes_by_usernames", get_votes_by_usernames)
+    monkeypatch.setattr(vote_reconciler, "upsert_votes", upsert_votes)
+    monkeypatch.setattr(vote_reconciler, "async_session", async_session)
+    return instance, db, upserts
+
+
+def new_cycle():
+    return {"drifted": 0, "missing_in_db": 0, "redis_behind": 0, "repaired": 0}
+
+
+@pytest.mark.parametrize("count", [1, 4])
+async def test_missing_in_redis_repair_restores_leaderboard(redis, shards, monkeypatch, count):
+    shards(count)
+    reconciler = VoteReconciler()
+    monkeypatch.setattr(reconciler, "repair", True)
+    # 修复期间新写入的票数不会被覆盖
+    await redis.zadd(vote_shards.key_for("vote_leaderboard", "fresh"), {"fresh": 9})
+    cycle = {"missing_in_redis": 0, "repaired": 0}
+
+    await reconciler.check_db_page([("lost", 5, 3), ("fresh", 2, 1)], cycle)
+
+    assert await redis.hget(vote_shards.key_for("user_votes", "lost"), "lost") == "5"
+    assert await redis.zscore(vote_shards.key_for("vote_leaderboard", "lost"), "lost") == 5
+    assert await redis.zscore(vote_shards.key_for("vote_leaderboard", "fresh"), "fresh") == 9
+    assert cycle == {"missing_in_redis": 2, "repaired": 2}
+
+
+async def test_lagging_user_that_caught_up_is_not_drift(redis, reconciler):
+    instance, db, upserts = reconciler
+    await redis.hset("user_votes", "alice", 5)
+    await redis.set("vote_version", 100)
+    db["alice"] = (3, 40)
+    await instance.check_redis_chunk(["alice"], {"checked": 0})
+
+    # 宽限期内消费者写入了alice最后一次投票的事件，版本号仍低于快照时的全局版本号
+    db["alice"] = (5, 42)
+    cycle = new_cycle()
+    await instance.confirm_suspects(cycle)
+
+    assert cycle == new_cycle()
+    assert upserts == {}
+    assert instance.suspects == {}
+
+
+async def test_user_still_lagging_is_repaired_in_db(redis, reconciler):
+    instance, db, upserts = reconciler
+    await redis.hset("user_votes", "alice", 5)
+    await redis.set("vote_version", 100)
+    db["alice"] = (3, 40)
+    await instance.check_redis_chunk(["alice"], {"checked": 0})
+
+    cycle = new_cycle()
+    await instance.confirm_suspects(cycle)
+
+    assert cycle["drifted"] == 1
+    assert upserts == {"alice": (5, 100)}
+
+
+async def test_user_voted_since_snapshot_is_rechecked(redis, reconciler):
+    instance, db, upserts = reconciler
+    await redis.hset("user_votes", "alice", 5)
+    await redis.set("vote_version", 100)
+    db["alice"] = (3, 40)
+    await instance.check_redis_chunk(["alice"], {"checked": 0})
+
+    await redis.hset("user_votes", "alice", 6)
+    await redis.set("vote_version", 101)
+    cycle = new_cycle()
+    await instance.confirm_suspects(cycle)
+
+    assert cycle == new_cycle()
+    assert instance.suspects["alice"][:2] == (6, 101)
+
+
+async def test_redis_behind_db_is_repaired_in_redis(redis, reconciler):
+    instance, db, upserts = reconciler
+    # 故障转移丢失了已转发到Kafka的写入
+    await redis.hset("user_votes", "alice", 5)
+    await redis.set("vote_version", 100)
+    db["alice"] = (7, 120)
+    await instance.check_redis_chunk(["alice"], {"checked": 0})
+
+    cycle = new_cycle()
+    await instance.confirm_suspects(cycle)
+
+    assert cycle["redis_behind"] == 1 and cycle["repaired"] == 1
+    assert upserts == {}
+    assert await redis.hget("user_votes", "alice") == "7"
+    assert await redis.zscore("vote_leaderboard", "alice") == 7
+    assert await redis.get("vote_version") == "120"
@@ -0,0 +1,120 @@
+import pytest
+
+from app.services.script_registry import script_registry
+from app.services.vote_service import vote_service
+from app.services.vote_shards import vote_shards
+from conftest import mark_ready, new_ticket
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=[1, 4], ids=["unsharded", "sharded"])
+async def striping(request, redis, shards, monkeypatch):
+    """开启条带，"hot"固定为热点用户，后台合并任务不启动（由测试显式调用fold_once）"""
+    shards(request.param)
+    await mark_ready(redis)
+    stripes = vote_service.stripes
+    monkeypatch.setattr(stripes, "enabled", True)
+    monkeypatch.setattr(stripes, "count", 4)
+    monkeypatch.setattr(stripes, "_ensure_folder", lambda: None)
+    monkeypatch.setattr(stripes.detector, "observe", lambda usernames: False)
+    monkeypatch.setattr(stripes.detector, "hot", {"hot"})
+    monkeypatch.setattr(stripes, "_striped", {"hot"})
+    return stripes
+
+
+async def vote(usernames, counts):
+    result = await vote_service.vote_for_users(usernames, counts, await new_ticket())
+    assert result["success"], result
+    return result["votes"]
+
+
+async def test_vote_returns_stripe_inclusive_total(striping, kafka_events):
+    assert await vote(["hot", "cold"], [2, 1]) == [2, 1]
+    assert await vote(["hot"], [3]) == [5]
+
+    # 总票数尚未变化，票数在条带中
+    user_votes = vote_shards.key_for("user_votes", "hot")
+    assert await striping.redis.hget(user_votes, "hot") is None
+    assert await vote_service.get_users_votes(["hot", "cold"]) == [5, 1]
+    # 条带中的票数不产生事件
+    assert [event[0] for event in kafka_events] == [["cold"]]
+
+
+async def test_batched_path_keeps_striping(striping, monkeypatch):
+    monkeypatch.setattr(vote_service, "batch_enabled", True)
+    assert await vote(["hot"], [2]) == [2]
+    assert await vote(["hot"], [2]) == [4]
+
+
+async def test_fold_reports_exact_total(striping, kafka_events):
+    await vote(["hot"], [2])
+    await vote(["hot"], [3])
+
+    await striping.fold_once({"hot": float("inf")})
+
+    assert await striping.redis.hget(vote_shards.key_for("user_votes", "hot"), "hot") == "5"
+    assert await vote_service.get_users_votes(["hot"]) == [5]
+    folded = [event for event in kafka_events if event[0] == ["hot"]]
+    assert folded[-1][1] == [5]
+    assert await striping.redis.zscore(vote_shards.key_for("vote_leaderboard", "hot"), "hot") == 5
+
+
+async def test_fold_is_idempotent_after_crash_before_ack(striping, kafka_events, monkeypatch):
+    await vote(["hot"], [2])
+    await vote(["hot"], [3])
+
+    # 合并已写入总票数，确认之前崩溃
+    ack = script_registry.evalsha
+
+    async def crash_on_ack(name, keys, args=None):
+        if name == "ack_stripes":
+            raise ConnectionError("crashed before ack")
+        return await ack(name, keys, args)
+    monkeypatch.setattr(script_registry, "evalsha", crash_on_ack)
+    with pytest.raises(ConnectionError):
+        await striping.fold_once({"hot": float("inf")})
+    monkeypatch.setattr(script_registry, "evalsha", ack)
+
+    # 取出的票数仍标记为未确认，但已按序号合并，读取不会重复计数
+    assert await vote_service.get_users_votes(["hot"]) == [5]
+    assert await vote(["hot"], [1]) == [6]
+
+    # 重试时取回同一序号，总票数一侧跳过，随后确认
+    await striping.fold_once({"hot": float("inf")})
+    await striping.fold_once({"hot": float("inf")})
+
+    assert await striping.redis.hget(vote_shards.key_for("user_votes", "hot"), "hot") == "6"
+    assert await vote_service.get_users_votes(["hot"]) == [6]
+    for key in vote_shards.keys("vote_stripes"):
+        assert not [field for field in await striping.redis.hgetall(key) if field.endswith(":out")]
+    assert [event[1] for event in kafka_events if event[0] == ["hot"]][-1] == [6]
+
+
+async def test_stripes_spread_over_shards(striping):
+    for _ in range(40):
+        await vote(["hot"], [1])
+
+    used = [key for key in vote_shards.keys("vote_stripes") if await striping.redis.hlen(key)]
+    assert len(used) == min(striping.count, vote_shards.count)
+    assert await vote_service.get_users_votes(["hot"]) == [40]
+
+
+async def test_cold_votes_do_not_touch_stripes(striping):
+    assert await vote(["cold"], [1]) == [1]
+
+    for key in vote_shards.keys("vote_stripes"):
+        assert await striping.redis.hlen(key) == 0
+
+
+async def test_total_updates_evict_striped_users_from_cache(striping, monkeypatch):
+    cache = vote_service.cache
+    monkeypatch.setattr(cache, "_subscribed", True)
+    cache.put_many({"hot": 7, "cold": 1})
+
+    # 总票数更新消息不包含条带，条带用户移出缓存，下次读取时加上条带
+    cache._apply_update(["hot", "cold"], [5, 2])
+
+    assert "hot" not in cache._entries
+    assert cache._entries["cold"][0] == 2
+    cache._entries.clear()